@@ -12,7 +12,7 @@ import sys
 import re
 import argparse
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 # 优先使用新 SDK
@@ -78,10 +78,41 @@ class GeminiClient:
     def use_new_sdk(self):
         return USE_NEW_SDK
 
-    def generate_content(self, prompt: str) -> Dict:
+    def create_cached_content(self, system_instruction: str, ttl: int = 3600) -> Optional[str]:
+        """
+        创建显式上下文缓存（仅新 SDK 支持）
+
+        Args:
+            system_instruction: 需要缓存的静态系统提示词
+            ttl: 缓存有效期（秒）
+
+        Returns:
+            缓存名称（用于 generate_content 的 cached_content 参数），失败返回 None
+        """
+        if not self.use_new_sdk:
+            return None
+        try:
+            from google.genai import types
+            cache = self.client.caches.create(
+                model=self.model_name,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    ttl=f"{ttl}s",
+                )
+            )
+            return cache.name
+        except Exception as e:
+            print(f"⚠️ 创建上下文缓存失败: {e}")
+            return None
+
+    def generate_content(self, prompt: str, cached_content: str = None) -> Dict:
         """
         生成内容
 
+        Args:
+            prompt: 提示词
+            cached_content: create_cached_content 返回的缓存名称（可选，仅新 SDK）
+
         Returns:
             {'text': '生成内容', 'tokens': int, 'input_tokens': int, 'output_tokens': int,
              'success': bool, 'error': str}
@@ -89,9 +120,14 @@ class GeminiClient:
         try:
             if self.use_new_sdk:
                 # 新 SDK
+                kwargs = {}
+                if cached_content:
+                    from google.genai import types
+                    kwargs['config'] = types.GenerateContentConfig(cached_content=cached_content)
                 response = self.client.models.generate_content(
                     model=self.model_name,
-                    contents=prompt
+                    contents=prompt,
+                    **kwargs
                 )
                 text = response.text
                 # 新 SDK token 信息
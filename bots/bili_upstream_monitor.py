@@ -12,24 +12,110 @@ import sys
 import json
 import asyncio
 import argparse
-import re
+import logging
+import time
 from pathlib import Path
 from datetime import datetime
 
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_CONFIG_PATH = PROJECT_ROOT / "config" / "bili_monitor.json"
+SUBTITLES_ROOT = PROJECT_ROOT / "output" / "subtitles"
+USER_INFO_CACHE_PATH = PROJECT_ROOT / "data" / "user_info.json"
+
 # 添加项目根目录到路径
-sys.path.insert(0, str(Path(__file__).parent.parent))
+sys.path.insert(0, str(PROJECT_ROOT))
 
-# Windows编码修复
+# Windows编码修复（已是 UTF-8 时跳过，原地 reconfigure 而不是重新包装）
 if sys.platform == 'win32':
-    import io
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
-    sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+    for _stream in (sys.stdout, sys.stderr):
+        if (getattr(_stream, 'encoding', '') or '').lower() not in ('utf-8', 'utf8'):
+            _stream.reconfigure(encoding='utf-8', errors='replace')
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 # 导入现有模块
 from second_brain.monitor import BilibiliAPI, VideoMonitor
 from second_brain.database import Database
 from bots.telegram_notifier import TelegramNotifier
 
+logger = logging.getLogger("bili.upstream")
+
+# Telegram 单条消息长度上限 / 每批最多合并的通知数
+TELEGRAM_MESSAGE_LIMIT = 4096
+NOTIFY_BATCH_SIZE = 10
+NOTIFY_SEPARATOR = "\n---\n"
+
+# 文件名非法字符 -> '_'
+_SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+# UP主信息缓存: str(uid) -> (过期时间戳, 用户信息)
+# 键统一为字符串：配置里的 uid 可能是 int，而写入 JSON 后键都会变成字符串
+USER_INFO_CACHE_SIZE = 512
+USER_INFO_CACHE_TTL = 3600
+_USER_INFO_CACHE = {}
+
+
+def cached_get_user_info(uid: str):
+    """带 TTL 的 BilibiliAPI.get_user_info，只缓存成功的结果"""
+    key = str(uid)
+    entry = _USER_INFO_CACHE.get(key)
+    if entry and entry[0] > time.time():
+        return entry[1]
+
+    info = BilibiliAPI.get_user_info(uid)
+    if info:
+        _USER_INFO_CACHE.pop(key, None)
+        if len(_USER_INFO_CACHE) >= USER_INFO_CACHE_SIZE:
+            # 淘汰最早写入的条目
+            _USER_INFO_CACHE.pop(next(iter(_USER_INFO_CACHE)))
+        _USER_INFO_CACHE[key] = (time.time() + USER_INFO_CACHE_TTL, info)
+    return info
+
+
+def load_user_info_cache(path: Path = USER_INFO_CACHE_PATH):
+    """从磁盘加载未过期的UP主信息缓存（用于重启后热启动）"""
+    if not path.exists():
+        return
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning("⚠️ 读取UP主信息缓存失败: %s", e)
+        return
+    if not isinstance(data, dict):
+        logger.warning("⚠️ UP主信息缓存格式错误，已忽略: %s", path)
+        return
+
+    now = time.time()
+    skipped = 0
+    for uid, entry in data.items():
+        # 每条应为 [过期时间戳, 用户信息]
+        if (not isinstance(entry, list) or len(entry) != 2
+                or not isinstance(entry[0], (int, float))):
+            skipped += 1
+            continue
+        expires_at, info = entry
+        if expires_at > now:
+            _USER_INFO_CACHE[str(uid)] = (expires_at, info)
+    if skipped:
+        logger.warning("⚠️ 跳过 %d 条格式错误的UP主信息缓存", skipped)
+
+
+def save_user_info_cache(path: Path = USER_INFO_CACHE_PATH):
+    """把UP主信息缓存写入磁盘"""
+    if not _USER_INFO_CACHE:
+        return
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(_USER_INFO_CACHE, f, ensure_ascii=False)
+    except OSError as e:
+        logger.warning("⚠️ 保存UP主信息缓存失败: %s", e)
+
 
 class BiliUpstreamMonitor:
     """B站UP主监控器"""
@@ -65,10 +151,13 @@ class BiliUpstreamMonitor:
         # 初始化监控器
         self.monitor = VideoMonitor(self.db)
 
+        # 通知队列 (仅在 on_new_videos 运行期间存在)
+        self._notify_queue = None
+
     def _load_config(self, config_path: str = None) -> dict:
         """加载配置文件"""
         if config_path is None:
-            config_path = Path(__file__).parent.parent / "config" / "bili_monitor.json"
+            config_path = DEFAULT_CONFIG_PATH
         else:
             config_path = Path(config_path)
 
@@ -92,6 +181,7 @@ class BiliUpstreamMonitor:
 
         # 添加到数据库（如果不存在）
         creators = []
+        pending = []  # 需要写入数据库的UP主: (creator_info, api_info)
         for creator_info in creators_list:
             if not creator_info.get('enabled', True):
                 continue
@@ -101,32 +191,39 @@ class BiliUpstreamMonitor:
             if existing:
                 creator_info['db_id'] = existing['id']
             else:
-                # 获取UP主信息
-                api_info = BilibiliAPI.get_user_info(creator_info['uid'])
-                if api_info:
-                    creator_info['db_id'] = self.db.add_creator(
-                        platform='bilibili',
-                        uid=creator_info['uid'],
-                        name=api_info.get('name', creator_info.get('name', '')),
-                        category=creator_info.get('category', ''),
-                        avatar_url=api_info.get('avatar'),
-                        fans_count=api_info.get('fans', 0),
-                        enabled=True
-                    )
-                else:
-                    # API失败，使用配置文件中的信息
-                    creator_info['db_id'] = self.db.add_creator(
-                        platform='bilibili',
-                        uid=creator_info['uid'],
-                        name=creator_info.get('name', ''),
-                        category=creator_info.get('category', ''),
-                        enabled=True
-                    )
+                # 获取UP主信息（网络请求放在事务外，避免长时间持有写锁）
+                pending.append((creator_info, cached_get_user_info(creator_info['uid'])))
 
             # 添加 platform 字段
             creator_info['platform'] = 'bilibili'
+            # 缓存用作目录名的UP主名称
+            creator_info['safe_name'] = creator_info.get('name', '').translate(_SANITIZE_TABLE)
             creators.append(creator_info)
 
+        # 批量写入，只提交一次
+        if pending:
+            with self.db.transaction():
+                for creator_info, api_info in pending:
+                    if api_info:
+                        creator_info['db_id'] = self.db.add_creator(
+                            platform='bilibili',
+                            uid=creator_info['uid'],
+                            name=api_info.get('name', creator_info.get('name', '')),
+                            category=creator_info.get('category', ''),
+                            avatar_url=api_info.get('avatar'),
+                            fans_count=api_info.get('fans', 0),
+                            enabled=True
+                        )
+                    else:
+                        # API失败，使用配置文件中的信息
+                        creator_info['db_id'] = self.db.add_creator(
+                            platform='bilibili',
+                            uid=creator_info['uid'],
+                            name=creator_info.get('name', ''),
+                            category=creator_info.get('category', ''),
+                            enabled=True
+                        )
+
         return creators
 
     async def analyze_video(self, video: dict, creator: dict) -> dict:
@@ -140,12 +237,8 @@ class BiliUpstreamMonitor:
         Returns:
             分析结果
         """
-        print(f"\n{'='*60}")
-        print(f"🤖 开始分析视频")
-        print(f"{'='*60}")
-        print(f"📺 UP主: {creator['name']}")
-        print(f"🎬 视频: {video['title'][:50]}...")
-        print(f"🔗 链接: {video['url']}")
+        logger.info("🤖 开始分析视频 | UP主: %s | 视频: %s... | 链接: %s",
+                    creator['name'], video['title'][:50], video['url'])
 
         # 动态导入 auto_bili_workflow
         try:
@@ -166,14 +259,16 @@ class BiliUpstreamMonitor:
 
             # 更新分析状态
             if success:
-                self.db.update_analysis_status(
+                await asyncio.to_thread(
+                    self.db.update_analysis_status,
                     video['db_id'],
                     status='completed',
                     model=self.analysis_model,
                     mode=self.analysis_mode
                 )
             else:
-                self.db.update_analysis_status(
+                await asyncio.to_thread(
+                    self.db.update_analysis_status,
                     video['db_id'],
                     status='failed',
                     error_message='Analysis failed'
@@ -182,9 +277,7 @@ class BiliUpstreamMonitor:
             return result
 
         except Exception as e:
-            print(f"❌ 分析失败: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("❌ 分析失败: %s", e)
             return {
                 'success': False,
                 'video_id': video['video_id'],
@@ -221,34 +314,108 @@ class BiliUpstreamMonitor:
         if summary and summary.get('success'):
             # 尝试读取生成的摘要文件
             try:
-                subtitle_dir = Path(__file__).parent.parent / "output" / "subtitles" / re.sub(r'[<>:"/\\|?*]', '_', creator['name'])
+                safe_name = creator.get('safe_name') or creator['name'].translate(_SANITIZE_TABLE)
+                subtitle_dir = SUBTITLES_ROOT / safe_name
                 summary_files = list(subtitle_dir.glob("*_AI总结.md"))
                 if summary_files:
-                    with open(summary_files[-1], 'r', encoding='utf-8') as f:
-                        summary_content = f.read()
-
-                    # 提取摘要部分（跳过标题）
+                    # 提取摘要部分（跳过标题），逐行读取，凑够行数即停止
                     lines = []
                     in_summary = False
-                    for line in summary_content.split('\n'):
-                        if '视频大意' in line or '核心观点' in line or '摘要' in line:
-                            in_summary = True
-                        if in_summary:
-                            lines.append(line)
-                            if len(lines) > 10:  # 限制行数
-                                break
-
-                    summary_text = '\n'.join(lines)
+                    with open(summary_files[-1], 'r', encoding='utf-8') as f:
+                        for line in f:
+                            if not in_summary and ('视频大意' in line or '核心观点' in line or '摘要' in line):
+                                in_summary = True
+                            if in_summary:
+                                lines.append(line)
+                                if len(lines) > 10:  # 限制行数
+                                    break
+
+                    summary_text = ''.join(lines).rstrip('\n')
                     if len(summary_text) > 300:
                         summary_text = summary_text[:300] + '...'
 
                     message += f"\n📝 *AI摘要*:\n{summary_text}"
             except Exception as e:
-                print(f"⚠️ 读取摘要文件失败: {e}")
+                logger.warning("⚠️ 读取摘要文件失败: %s", e)
 
-        # 发送通知
-        self.notifier.send_message(message, parse_mode="Markdown")
-        print(f"✅ 通知已发送")
+        # 发送通知：处理新视频期间放入队列，由后台任务合并发送
+        if self._notify_queue is not None:
+            self._notify_queue.put_nowait(message)
+        elif self.notifier.send_message(message, parse_mode="Markdown"):
+            logger.info("✅ 通知已发送")
+        else:
+            logger.warning("⚠️ 通知发送失败: %s", message[:100])
+
+    @staticmethod
+    def _pack_messages(messages: list) -> list:
+        """把多条通知分组，每组合并后不超过 Telegram 长度上限，返回分组列表"""
+        packed = []
+        current = []
+        current_len = 0
+        for message in messages:
+            if current and current_len + len(NOTIFY_SEPARATOR) + len(message) <= TELEGRAM_MESSAGE_LIMIT:
+                current.append(message)
+                current_len += len(NOTIFY_SEPARATOR) + len(message)
+            else:
+                if current:
+                    packed.append(current)
+                current = [message]
+                current_len = len(message)
+        if current:
+            packed.append(current)
+        return packed
+
+    async def _send_notification_group(self, group: list) -> int:
+        """
+        发送一组合并的通知，失败时逐条重发
+
+        Returns:
+            发送失败的通知条数
+        """
+        text = NOTIFY_SEPARATOR.join(group)
+        if await asyncio.to_thread(self.notifier.send_message, text, parse_mode="Markdown"):
+            return 0
+        if len(group) == 1:
+            logger.warning("⚠️ 通知发送失败: %s", group[0][:100])
+            return 1
+
+        # 合并消息中任一条 (如 Markdown 解析失败) 会导致整组失败，逐条重发
+        logger.warning("⚠️ 合并通知发送失败，逐条重发 (%d 条)", len(group))
+        failed = 0
+        for message in group:
+            if not await asyncio.to_thread(self.notifier.send_message, message, parse_mode="Markdown"):
+                logger.warning("⚠️ 通知发送失败: %s", message[:100])
+                failed += 1
+        return failed
+
+    async def _notify_worker(self):
+        """后台发送通知：取出队列中已积压的消息，合并后发送，收到 None 时退出"""
+        queue = self._notify_queue
+        closed = False
+        while not closed:
+            message = await queue.get()
+            if message is None:
+                break
+
+            batch = [message]
+            while len(batch) < NOTIFY_BATCH_SIZE and not queue.empty():
+                message = queue.get_nowait()
+                if message is None:
+                    closed = True
+                    break
+                batch.append(message)
+
+            failed = 0
+            for group in self._pack_messages(batch):
+                failed += await self._send_notification_group(group)
+            if failed < len(batch):
+                logger.info("✅ 通知已发送 (%d 条)", len(batch) - failed)
+
+    def _create_pending_statuses(self, videos: list):
+        """在同一个事务中为视频创建 pending 分析状态"""
+        with self.db.transaction():
+            for video in videos:
+                self.db.create_analysis_status(video['id'], status='pending')
 
     async def on_new_videos(self, new_videos: list, creators: list):
         """
@@ -261,19 +428,34 @@ class BiliUpstreamMonitor:
         if not new_videos:
             return
 
-        print(f"\n{'='*60}")
-        print(f"🎉 发现 {len(new_videos)} 个新视频！")
-        print(f"{'='*60}")
+        logger.info("🎉 发现 %d 个新视频！", len(new_videos))
 
+        tasks = []
         for video in new_videos:
             creator = next((c for c in creators if c.get('db_id') == video.get('creator_id')), None)
             if not creator:
-                print(f"⚠️ 未找到UP主信息: {video}")
+                logger.warning("⚠️ 未找到UP主信息: %s", video)
                 continue
+            tasks.append((video, creator))
 
-            # 创建分析状态
-            self.db.create_analysis_status(video['id'], status='pending')
+        # 批量创建分析状态，只提交一次（在线程中执行，不阻塞事件循环）
+        await asyncio.to_thread(self._create_pending_statuses, [video for video, _ in tasks])
 
+        if self.notifier:
+            self._notify_queue = asyncio.Queue()
+            worker = asyncio.create_task(self._notify_worker())
+        try:
+            await self._process_videos(tasks)
+        finally:
+            if self.notifier:
+                # 发送剩余通知后退出
+                self._notify_queue.put_nowait(None)
+                await worker
+                self._notify_queue = None
+
+    async def _process_videos(self, tasks: list):
+        """逐个分析视频并发送通知"""
+        for video, creator in tasks:
             # 自动分析
             if self.auto_analyze:
                 try:
@@ -283,49 +465,56 @@ class BiliUpstreamMonitor:
                     self.send_notification(video, creator, result)
 
                 except Exception as e:
-                    print(f"❌ 处理视频失败: {e}")
+                    logger.error("❌ 处理视频失败: %s", e)
                     # 即使处理失败，也发送通知
                     self.send_notification(video, creator)
             else:
                 # 不自动分析，只发送通知
                 self.send_notification(video, creator)
 
+    @staticmethod
+    def _filter_recent(videos: list, window: int = 600) -> list:
+        """
+        过滤出最近发布的视频
+
+        Args:
+            videos: 视频列表 (需包含 published_ts)
+            window: 时间窗口 (秒)
+        """
+        now_ts = int(time.time())
+        return [v for v in videos
+                if v.get('published_ts') and now_ts - v['published_ts'] < window]
+
     def run_once(self):
         """运行一次检查"""
-        print(f"\n{'='*70}")
-        print(f"🔍 B站UP主监控系统")
-        print(f"{'='*70}")
+        logger.info("🔍 B站UP主监控系统")
 
         # 加载UP主列表
         creators = self.load_creators()
         if not creators:
-            print("❌ 没有启用的UP主，请检查配置文件")
+            logger.error("❌ 没有启用的UP主，请检查配置文件")
             return
 
-        print(f"📺 监控UP主: {len(creators)} 个")
-        for creator in creators:
-            print(f"  • {creator['name']} ({creator['uid']})")
+        logger.info("📺 监控UP主: %d 个", len(creators))
+        if logger.isEnabledFor(logging.DEBUG):
+            for creator in creators:
+                logger.debug("  • %s (%s)", creator['name'], creator['uid'])
 
         # 运行检查
         stats = self.monitor.run_once(creators)
 
-        # 获取新视频并处理
-        new_videos = self.db.get_unanalyzed_videos(limit=100)
-        if new_videos:
+        # 获取新视频并处理（本轮没有新视频时无需查询数据库）
+        if stats.get('new_videos', 0):
+            new_videos = self.db.get_videos_by_ids(stats['new_video_ids'])
             # 过滤出最近的新视频（10分钟内）
-            import time
-            recent_videos = [v for v in new_videos
-                           if v.get('published_at') and
-                           (datetime.now() - datetime.fromisoformat(v['published_at'])).total_seconds() < 600]
+            recent_videos = self._filter_recent(new_videos)
 
             if recent_videos:
                 # 异步处理
                 asyncio.run(self.on_new_videos(recent_videos, creators))
 
-        print(f"\n📊 统计信息:")
-        print(f"  • 检查UP主: {stats['total_creators']} 个")
-        print(f"  • 新增视频: {stats['new_videos']} 个")
-        print(f"  • 耗时: {stats['elapsed_time']:.1f} 秒")
+        logger.info("📊 统计信息: 检查UP主 %d 个, 新增视频 %d 个, 耗时 %.1f 秒",
+                    stats['total_creators'], stats['new_videos'], stats['elapsed_time'])
 
     def run_loop(self, max_iterations: int = None):
         """
@@ -337,16 +526,14 @@ class BiliUpstreamMonitor:
         # 加载UP主列表
         creators = self.load_creators()
         if not creators:
-            print("❌ 没有启用的UP主，请检查配置文件")
+            logger.error("❌ 没有启用的UP主，请检查配置文件")
             return
 
         # 定义回调
         def callback(new_videos):
             # 只处理最近的新视频
             if new_videos:
-                recent_videos = [v for v in new_videos
-                               if v.get('published_at') and
-                               (datetime.now() - datetime.fromisoformat(v['published_at'])).total_seconds() < 600]
+                recent_videos = self._filter_recent(new_videos)
                 if recent_videos:
                     asyncio.run(self.on_new_videos(recent_videos, creators))
 
@@ -367,7 +554,7 @@ def init_config(config_path: str = None):
         config_path: 配置文件路径 (默认: config/bili_monitor.json)
     """
     if config_path is None:
-        config_path = Path(__file__).parent.parent / "config" / "bili_monitor.json"
+        config_path = DEFAULT_CONFIG_PATH
     else:
         config_path = Path(config_path)
 
@@ -407,11 +594,14 @@ def init_config(config_path: str = None):
 
     # 保存配置
     config_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(config_path, 'w', encoding='utf-8') as f:
-        json.dump(default_config, f, indent=2, ensure_ascii=False)
+    if HAS_ORJSON:
+        config_path.write_bytes(orjson.dumps(default_config, option=orjson.OPT_INDENT_2))
+    else:
+        with open(config_path, 'w', encoding='utf-8') as f:
+            json.dump(default_config, f, indent=2, ensure_ascii=False)
 
-    print(f"✅ 配置文件已创建: {config_path}")
-    print(f"📝 请编辑配置文件，添加要监控的UP主信息")
+    logger.info("✅ 配置文件已创建: %s", config_path)
+    logger.info("📝 请编辑配置文件，添加要监控的UP主信息")
 
 
 def main():
@@ -452,12 +642,18 @@ def main():
 
     args = parser.parse_args()
 
+    logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
     # 初始化配置
     if args.init:
         init_config(args.config)
         return 0
 
     # 运行监控
+    load_user_info_cache()
     try:
         monitor = BiliUpstreamMonitor(config_path=args.config)
 
@@ -474,13 +670,13 @@ def main():
         return 0
 
     except KeyboardInterrupt:
-        print("\n\n⚠️ 用户中断")
+        logger.warning("⚠️ 用户中断")
         return 0
     except Exception as e:
-        print(f"\n❌ 错误: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("❌ 错误: %s", e)
         return 1
+    finally:
+        save_user_info_cache()
 
 
 if __name__ == "__main__":
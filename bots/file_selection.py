@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+文件选择解析模块
+
+help-bot 执行命令后，用户用自然语言选择要发送的文件。
+常见的固定写法（退出、全部、编号列表、只要某类文件）在本地解析，
+只有自由表述才需要调用 Gemini。
+"""
+
+import re
+from typing import Dict, List, Optional
+
+
+# Deterministic file selection inputs that don't need a Gemini call
+EXIT_KEYWORDS = ['完成', '结束', '退出', 'exit', 'done', 'finish', 'quit', 'no', '不需要', 'cancel']
+_EXIT_KEYWORD_RE = re.compile("|".join(map(re.escape, EXIT_KEYWORDS)))
+_SELECT_ALL_KEYWORDS = frozenset({'全部', '全部发送', '发全部', '都要', 'all'})
+_NUMBER_LIST_RE = re.compile(r'(?:\d|[\s,，、和]|and)+')
+_ONLY_TYPE_RE = re.compile(r'(?:只要|只发|只需要)(.+?)(?:文件)?')
+FILE_TYPE_KEYWORDS = {
+    '视频': '视频文件',
+    '字幕': '字幕文件',
+    '数据': '数据文件',
+    '文档': '文档文件',
+    '图片': '图片文件',
+    '报告': 'AI分析报告',
+}
+
+
+def match_file_selection(user_input: str, available_files: List[Dict]) -> Optional[List[int]]:
+    """
+    在本地解析文件选择
+
+    Args:
+        user_input: 用户回复
+        available_files: 可选文件列表（含 type 字段），编号从 1 开始展示给用户
+
+    Returns:
+        0 起始的文件索引列表；退出时返回 [-1]；
+        无法在本地解析（需要 Gemini）时返回 None
+    """
+    user_input_lower = user_input.lower().strip()
+
+    # Check for exit commands first (simple keywords)
+    if _EXIT_KEYWORD_RE.search(user_input_lower):
+        return [-1]  # Special value: -1 means exit file selection
+
+    # "全部" / "all"
+    if user_input_lower in _SELECT_ALL_KEYWORDS:
+        return list(range(len(available_files)))
+
+    # "1,3,5" / "1 和 3" style lists use the 1-based numbers shown to the user
+    if _NUMBER_LIST_RE.fullmatch(user_input_lower) and any(c.isdigit() for c in user_input_lower):
+        indices = [int(x) - 1 for x in re.findall(r'\d+', user_input_lower)]
+        return [i for i in indices if 0 <= i < len(available_files)]
+
+    # "只要文档" / "只要视频"
+    match = _ONLY_TYPE_RE.fullmatch(user_input_lower)
+    if match and match.group(1) in FILE_TYPE_KEYWORDS:
+        file_type = FILE_TYPE_KEYWORDS[match.group(1)]
+        return [i for i, f in enumerate(available_files) if f.get('type') == file_type]
+
+    return None
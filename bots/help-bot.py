@@ -14,10 +14,22 @@ Features:
 import os
 import sys
 import json
+import html
+import stat
+import fnmatch
 import asyncio
 import subprocess
 import time
 import re
+import random
+import signal
+import threading
+import secrets
+import logging
+import functools
+import copy
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, Optional, List
 from datetime import datetime
@@ -35,13 +47,21 @@ if sys.platform == 'win32':
 # Import Telegram
 try:
     from telegram import Update
-    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, filters, ContextTypes
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument
 except ImportError:
     print("❌ 未安装 python-telegram-bot")
     print("请运行: pip install python-telegram-bot")
     sys.exit(1)
 
+# Import aiofiles (non-blocking file reads in handlers)
+try:
+    import aiofiles
+except ImportError:
+    print("❌ 未安装 aiofiles")
+    print("请运行: pip install aiofiles")
+    sys.exit(1)
+
 # Import Gemini
 try:
     from analysis.subtitle_analyzer import GeminiClient
@@ -50,17 +70,88 @@ except ImportError:
     print("请确保 analysis/subtitle_analyzer.py 存在")
     sys.exit(1)
 
+from bots.file_selection import match_file_selection
+
+# Optional: filesystem events for the generated-files index
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    HAS_WATCHDOG = True
+except ImportError:
+    HAS_WATCHDOG = False
+
+# Optional: faster JSON for Gemini replies, file previews and stored state
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# Optional: faster event loop (Linux/macOS only)
+try:
+    import uvloop
+    HAS_UVLOOP = True
+except ImportError:
+    HAS_UVLOOP = False
+
+# Optional: shared conversation state across bot replicas
+try:
+    import redis.asyncio as aioredis
+    HAS_REDIS = True
+except ImportError:
+    HAS_REDIS = False
+
+# Optional: PTB's AIORateLimiter (python-telegram-bot[rate-limiter]) paces sends
+# to Telegram's flood limits and retries RetryAfter instead of failing the handler
+try:
+    import aiolimiter  # noqa: F401  (required by AIORateLimiter)
+    from telegram.ext import AIORateLimiter
+    HAS_RATE_LIMITER = True
+except ImportError:
+    HAS_RATE_LIMITER = False
+
+# ==================== Logging ====================
+
+# Gemini diagnostics are DEBUG; set HELP_BOT_LOG_LEVEL=DEBUG to see them
+logging.basicConfig(
+    format='%(asctime)s - %(levelname)s - %(message)s',
+    level=os.environ.get('HELP_BOT_LOG_LEVEL', 'INFO').upper()
+)
+logging.getLogger('httpx').setLevel(logging.WARNING)  # One line per Telegram poll otherwise
+logger = logging.getLogger('help-bot')
+
+# ==================== JSON ====================
+
+if HAS_ORJSON:
+    json_loads = orjson.loads  # orjson.JSONDecodeError subclasses json.JSONDecodeError
+
+    def json_dumps(obj, indent: bool = False) -> str:
+        """Serialize obj to a str, pretty-printed with 2 spaces if indent"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None).decode('utf-8')
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj, indent: bool = False) -> str:
+        """Serialize obj to a str, pretty-printed with 2 spaces if indent"""
+        return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
 # ==================== Output Formatting ====================
 
+# Telegram Markdown special characters paired with their escaped form.
+# Chained str.replace beats both str.translate and re.sub here: each replace
+# is a C-level scan that returns the same object when the char is absent.
+_MD_ESCAPES = tuple((c, '\\' + c) for c in '_*[]()~`>#+-=|{}.!')
+
+
 def escape_markdown(text: str) -> str:
     """Escape special characters for Telegram Markdown"""
-    # Telegram Markdown special characters that need escaping
-    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+    for char, escaped in _MD_ESCAPES:
+        text = text.replace(char, escaped)
+    return text
 
-    for char in special_chars:
-        text = text.replace(char, f'\\{char}')
 
-    return text
+# Keywords highlighted by format_gemini_output, matched in a single pass
+_KEYWORD_RE = re.compile("|".join(map(re.escape, ["命令:", "参数:", "URL:", "模式:", "说明:", "文件:", "选择:"])))
 
 
 def format_gemini_output(text: str) -> str:
@@ -72,11 +163,7 @@ def format_gemini_output(text: str) -> str:
     text = text.replace("\n\n", "\n\n\n")
 
     # Highlight keywords
-    keywords = ["命令:", "参数:", "URL:", "模式:", "说明:", "文件:", "选择:"]
-    for kw in keywords:
-        text = text.replace(kw, f"**{kw}**")
-
-    return text
+    return _KEYWORD_RE.sub(r"**\g<0>**", text)
 
 
 # ==================== Configuration ====================
@@ -95,7 +182,33 @@ def load_config() -> Dict:
 config = load_config()
 BOT_TOKEN = config.get('bot_token')
 GEMINI_API_KEY = config.get('gemini_api_key')
-ALLOWED_USERS = config.get('allowed_users', [])
+# allowed_users may be a list of ids (numbers or strings) or "id1,id2"; Telegram
+# user ids are ints, so normalise before building the O(1) lookup set
+_allowed_users_raw = config.get('allowed_users', [])
+if isinstance(_allowed_users_raw, str):
+    _allowed_users_raw = _allowed_users_raw.split(',')
+_allowed_user_ids = set()
+_invalid_user_ids = []
+for _uid in _allowed_users_raw:
+    _uid = str(_uid).strip()
+    if not _uid:
+        continue
+    try:
+        _allowed_user_ids.add(int(_uid))
+    except ValueError:
+        _invalid_user_ids.append(_uid)
+if _invalid_user_ids:
+    print(f"⚠️ allowed_users 中的无效用户 ID（需为数字）已忽略: {', '.join(_invalid_user_ids)}")
+if _invalid_user_ids and not _allowed_user_ids:
+    # An empty ALLOWED_USERS means "everyone"; don't open the bot up because
+    # every configured entry was invalid
+    print("❌ allowed_users 中没有有效的用户 ID")
+    print(f"请在 {CONFIG_PATH} 中将 allowed_users 配置为数字 ID")
+    sys.exit(1)
+ALLOWED_USERS = frozenset(_allowed_user_ids)
+ENABLE_PROMPT_CACHE = config.get('enable_prompt_cache', False)
+STATE_BACKEND = config.get('state_backend', 'memory')  # "memory" | "redis"
+REDIS_URL = config.get('redis_url', 'redis://localhost:6379/0')
 
 if not BOT_TOKEN:
     print("❌ 未配置 Bot Token")
@@ -107,14 +220,30 @@ if not GEMINI_API_KEY:
     print(f"请在 {CONFIG_PATH} 中配置 gemini_api_key")
     sys.exit(1)
 
+# Shared Gemini client (reuses the SDK's HTTP session across messages)
+GEMINI_CLIENT = GeminiClient(model='flash-lite', api_key=GEMINI_API_KEY)
+
 
 # ==================== Conversation State Management ====================
 
+# Messages kept in a user's history; only the last HISTORY_WINDOW are sent to Gemini
+HISTORY_LIMIT = 20
+
+# Seconds an unanswered file selection keeps its file list
+FILE_SELECT_TTL = 600
+
+# Seconds of inactivity after which a user's in-memory state is dropped
+STATE_IDLE_TTL = 3600
+
+# Menu URLs kept per user for button callbacks (callback_data is capped at 64 bytes)
+URL_TOKEN_LIMIT = 8
+
+
 @dataclass
 class ConversationState:
     """Track conversation state per user"""
     phase: str = "dialogue"  # "dialogue" | "confirm" | "file_select" | "retry" | "custom_input"
-    history: List[str] = field(default_factory=list)  # Conversation history with Gemini
+    history: deque = field(default_factory=lambda: deque(maxlen=HISTORY_LIMIT))  # Conversation history with Gemini
     pending_command: Optional[Dict] = None  # Command waiting for confirmation
     generated_files: List[Dict] = field(default_factory=list)  # Files from last execution
     process: Optional[object] = None  # Currently running subprocess
@@ -124,11 +253,36 @@ class ConversationState:
     last_error_type: Optional[str] = None  # Type of last error (network/timeout/script/other)
     last_error_message: Optional[str] = None  # Last error message
     custom_input_type: Optional[str] = None  # Type of custom input expected (e.g., "bili_count", "xhs_count")
+    files_expire_at: Optional[float] = None  # time.time() deadline for an open file selection (persisted)
+    last_activity: float = field(default_factory=time.monotonic)  # Last get_user_state() for this user
+    url_tokens: Dict[str, str] = field(default_factory=dict)  # Short callback token -> video URL, oldest first
+
+    def url_token(self, url: str) -> str:
+        """Return a short token standing in for url in callback_data ("" for no URL)"""
+        if not url:
+            return ""
+        token = secrets.token_urlsafe(6)
+        self.url_tokens[token] = url
+        while len(self.url_tokens) > URL_TOKEN_LIMIT:
+            del self.url_tokens[next(iter(self.url_tokens))]
+        return token
+
+    def offer_files(self, files: List[Dict]):
+        """Enter file selection for files; abandoned selections are cleared after FILE_SELECT_TTL"""
+        self.generated_files = files
+        self.phase = "file_select"
+        self.files_expire_at = time.time() + FILE_SELECT_TTL
+
+    def selection_expired(self, now: float) -> bool:
+        """True if an open file selection is past its deadline (now is time.time())"""
+        return (self.phase == "file_select"
+                and self.files_expire_at is not None
+                and now > self.files_expire_at)
 
     def clear(self):
         """Clear conversation state"""
         self.phase = "dialogue"
-        self.history = []
+        self.history.clear()
         self.pending_command = None
         self.generated_files = []
         self.process = None
@@ -137,6 +291,7 @@ class ConversationState:
         self.last_error_type = None
         self.last_error_message = None
         self.custom_input_type = None
+        self.files_expire_at = None
 
 
 # Global state manager
@@ -146,17 +301,33 @@ user_processes = {}  # {user_id: asyncio.subprocess.Process}
 
 def get_user_state(user_id: int) -> ConversationState:
     """Get or create conversation state for user"""
-    if user_id not in user_states:
-        user_states[user_id] = ConversationState()
-    return user_states[user_id]
+    try:
+        state = user_states[user_id]
+    except KeyError:
+        state = user_states[user_id] = ConversationState()
+    state.last_activity = time.monotonic()
+    return state
+
+
+async def sweep_user_states():
+    """Periodically clear abandoned file selections and drop idle users' state"""
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        wall_now = time.time()
+        for user_id, state in list(user_states.items()):
+            if now - state.last_activity > STATE_IDLE_TTL and user_id not in user_processes:
+                del user_states[user_id]
+            elif state.selection_expired(wall_now):
+                state.clear()
 
 
-def get_user_process(user_id: int) -> Optional[object]:
+def get_user_process(user_id: int) -> Optional[asyncio.subprocess.Process]:
     """Get currently running process for user"""
     return user_processes.get(user_id)
 
 
-def set_user_process(user_id: int, process: object):
+def set_user_process(user_id: int, process: asyncio.subprocess.Process):
     """Set currently running process for user"""
     user_processes[user_id] = process
 
@@ -167,37 +338,188 @@ def clear_user_process(user_id: int):
         del user_processes[user_id]
 
 
+def stop_process_group(process: asyncio.subprocess.Process, force: bool = False):
+    """Terminate (or kill) a command and, on POSIX, the browsers it spawned
+
+    Commands run with start_new_session=True, so their pid is also the id of a
+    process group holding every descendant.
+    """
+    if sys.platform == 'win32':
+        if force:
+            process.kill()
+        else:
+            process.terminate()
+    else:
+        os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+
+
+async def kill_user_process(user_id: int):
+    """Kill the user's running command, if any, and wait briefly for it to exit"""
+    existing = get_user_process(user_id)
+    if existing and existing.returncode is None:
+        try:
+            stop_process_group(existing, force=True)
+            await asyncio.wait_for(existing.wait(), timeout=1.0)
+        except (ProcessLookupError, asyncio.TimeoutError):
+            pass
+
+
+class StateStore:
+    """Redis-backed copy of conversation state so replicas and restarts share it"""
+
+    KEY_PREFIX = "bot:state:"
+    TTL = 24 * 3600
+    # After a Redis error the bot runs on local state alone for this long
+    RETRY_AFTER = 30
+    # Running processes stay local to the replica that started them
+    PERSISTED_FIELDS = (
+        "phase", "history", "pending_command", "generated_files", "search_results",
+        "retry_count", "last_error_type", "last_error_message", "custom_input_type",
+        "url_tokens", "files_expire_at",
+    )
+
+    def __init__(self, url: str):
+        self.redis = aioredis.Redis.from_url(url)
+        self._retry_at = 0.0
+
+    @property
+    def available(self) -> bool:
+        """False while backing off after a Redis error"""
+        return time.monotonic() >= self._retry_at
+
+    def mark_failed(self, e: Exception):
+        """Fall back to in-memory state for RETRY_AFTER seconds"""
+        logger.warning("⚠️ [STATE] Redis unavailable, using local state for %ds: %s", self.RETRY_AFTER, e)
+        self._retry_at = time.monotonic() + self.RETRY_AFTER
+
+    async def load(self, user_id: int) -> Optional[Dict]:
+        """Return the persisted fields stored for user_id, or None"""
+        raw = await self.redis.get(f"{self.KEY_PREFIX}{user_id}")
+        if raw is None:
+            return None
+        return json_loads(raw)
+
+    async def save(self, user_id: int, state: ConversationState):
+        """Store persisted fields of state with a 24h TTL"""
+        data = {name: getattr(state, name) for name in self.PERSISTED_FIELDS}
+        data["history"] = list(state.history)
+        await self.redis.set(
+            f"{self.KEY_PREFIX}{user_id}",
+            json_dumps(data),
+            ex=self.TTL
+        )
+
+
+STATE_STORE: Optional[StateStore] = None
+
+
+async def load_state_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Refresh the local state from the store before handlers run"""
+    if not STATE_STORE or not STATE_STORE.available or not update.effective_user:
+        return
+    user_id = update.effective_user.id
+    # Handlers reject unauthorized users; don't allocate state for them
+    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
+        return
+    try:
+        data = await STATE_STORE.load(user_id)
+    except Exception as e:
+        STATE_STORE.mark_failed(e)
+        return
+    if data is None:
+        return
+    state = get_user_state(user_id)
+    for name in StateStore.PERSISTED_FIELDS:
+        if name in data:
+            setattr(state, name, data[name])
+    state.history = deque(state.history, maxlen=HISTORY_LIMIT)
+    # The sweep only clears local copies; drop a selection that expired in the store
+    if state.selection_expired(time.time()):
+        state.clear()
+
+
+async def save_state_hook(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Write the state back to the store after handlers ran"""
+    if (STATE_STORE and STATE_STORE.available
+            and update.effective_user and update.effective_user.id in user_states):
+        try:
+            await STATE_STORE.save(update.effective_user.id, user_states[update.effective_user.id])
+        except Exception as e:
+            STATE_STORE.mark_failed(e)
+
+
+# Environment for command scripts, built once: unbuffered UTF-8 output so
+# progress lines arrive as they are printed
+SUBPROCESS_ENV = {**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+
+# Lines of stdout/stderr kept per command; only the tail is ever shown
+PROCESS_OUTPUT_LINES = 1000
+
+
+async def _pump_lines(stream: asyncio.StreamReader, buf: deque):
+    """Decode lines from stream into a bounded buffer until EOF"""
+    while True:
+        try:
+            line = await stream.readline()
+        except ValueError:
+            # Line longer than the stream limit; it has been discarded
+            buf.append("...(行过长，已省略)\n")
+            continue
+        if not line:
+            break
+        buf.append(line.decode('utf-8', errors='replace'))
+
+
+async def read_process_output(process: asyncio.subprocess.Process) -> tuple:
+    """Wait for process and return the last PROCESS_OUTPUT_LINES of (stdout, stderr)"""
+    out_buf = deque(maxlen=PROCESS_OUTPUT_LINES)
+    err_buf = deque(maxlen=PROCESS_OUTPUT_LINES)
+    await asyncio.gather(
+        _pump_lines(process.stdout, out_buf),
+        _pump_lines(process.stderr, err_buf)
+    )
+    await process.wait()
+    return ''.join(out_buf), ''.join(err_buf)
+
+
 # ==================== Error Detection & Retry Logic ====================
 
+def _keyword_re(keywords: List[str]) -> "re.Pattern":
+    """Compile substring keywords into one alternation scanned in a single pass"""
+    return re.compile("|".join(map(re.escape, keywords)))
+
+
+# Network-related errors
+_NETWORK_ERROR_RE = _keyword_re([
+    'connection', 'network', 'connect error',
+    'connection refused', 'connection reset',
+    'dns', 'resolve', 'host unreachable',
+    'no route to host', 'network is unreachable',
+    'socket', 'http', 'request failed',
+    'timeout', 'timed out'
+])
+_TIMEOUT_ERROR_RE = _keyword_re(['timeout', 'timed out'])
+
+# Script execution errors
+_SCRIPT_ERROR_RE = _keyword_re([
+    'syntax', 'import error', 'attribute error',
+    'type error', 'value error', 'key error',
+    'indentation', 'invalid syntax',
+    'file not found', 'no such file'
+])
+
+
 def classify_error(error_str: str) -> str:
     """Classify error type for retry logic"""
     error_lower = error_str.lower()
 
-    # Network-related errors
-    network_keywords = [
-        'connection', 'network', 'connect error',
-        'connection refused', 'connection reset',
-        'dns', 'resolve', 'host unreachable',
-        'no route to host', 'network is unreachable',
-        'socket', 'http', 'request failed',
-        'timeout', 'timed out'
-    ]
-
     # Check if it's a network error
-    if any(kw in error_lower for kw in network_keywords):
-        if 'timeout' in error_lower or 'timed out' in error_lower:
+    if _NETWORK_ERROR_RE.search(error_lower):
+        if _TIMEOUT_ERROR_RE.search(error_lower):
             return 'timeout'
         return 'network'
 
-    # Script execution errors
-    script_keywords = [
-        'syntax', 'import error', 'attribute error',
-        'type error', 'value error', 'key error',
-        'indentation', 'invalid syntax',
-        'file not found', 'no such file'
-    ]
-
-    if any(kw in error_lower for kw in script_keywords):
+    if _SCRIPT_ERROR_RE.search(error_lower):
         return 'script'
 
     # Default: other error
@@ -223,55 +545,80 @@ def get_retry_delay(retry_count: int) -> float:
 
 # ==================== Command Map ====================
 
+@dataclass(frozen=True)
+class CommandSpec:
+    """Script invocation for a command; base_args is a tuple so it can't be mutated"""
+    script: str
+    base_args: tuple
+    url_arg_pos: Optional[int]
+    description: str
+    script_path: str = field(init=False)  # Absolute path, resolved once at import
+
+    def __post_init__(self):
+        object.__setattr__(self, "script_path", str((PROJECT_ROOT / self.script).resolve()))
+
+
 COMMAND_MAP = {
-    "download": {
-        "script": "auto_content_workflow.py",
-        "base_args": [],
-        "url_arg_pos": 0,
-        "description": "下载视频"
-    },
-    "subtitle": {
-        "script": "auto_content_workflow.py",
-        "base_args": ["--bili-mode", "subtitle"],
-        "url_arg_pos": 0,
-        "description": "B站字幕分析"
-    },
-    "notes": {
-        "script": "auto_content_workflow.py",
-        "base_args": ["--generate-notes"],
-        "url_arg_pos": 0,
-        "description": "生成学习笔记"
-    },
-    "comments": {
-        "script": "auto_content_workflow.py",
-        "base_args": ["--fetch-comments"],
-        "url_arg_pos": 0,
-        "description": "爬取评论"
-    },
-    "auto": {
-        "script": "auto_content_workflow.py",
-        "base_args": [],
-        "url_arg_pos": 0,
-        "description": "智能自动处理"
-    },
-    "bili_auto": {
-        "script": "auto_content_workflow.py",
-        "base_args": ["--bili-mode", "subtitle", "--fetch-comments"],
-        "url_arg_pos": 0,
-        "description": "B站组合处理（字幕+评论）"
-    },
-    "scrape_bilibili": {
-        "script": "workflows/ai_bilibili_homepage.py",
-        "base_args": ["--mode", "full"],
-        "url_arg_pos": None,
-        "description": "刷B站首页推荐"
-    },
-    "scrape_xiaohongshu": {
-        "script": "workflows/ai_xiaohongshu_homepage.py",
-        "base_args": ["--mode", "full"],
-        "url_arg_pos": None,
-        "description": "刷小红书推荐"
-    }
+    "download": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=(),
+        url_arg_pos=0,
+        description="下载视频"
+    ),
+    "subtitle": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=("--bili-mode", "subtitle"),
+        url_arg_pos=0,
+        description="B站字幕分析"
+    ),
+    "notes": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=("--generate-notes",),
+        url_arg_pos=0,
+        description="生成学习笔记"
+    ),
+    "comments": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=("--fetch-comments",),
+        url_arg_pos=0,
+        description="爬取评论"
+    ),
+    "auto": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=(),
+        url_arg_pos=0,
+        description="智能自动处理"
+    ),
+    "bili_auto": CommandSpec(
+        script="auto_content_workflow.py",
+        base_args=("--bili-mode", "subtitle", "--fetch-comments"),
+        url_arg_pos=0,
+        description="B站组合处理（字幕+评论）"
+    ),
+    "scrape_bilibili": CommandSpec(
+        script="workflows/ai_bilibili_homepage.py",
+        base_args=("--mode", "full"),
+        url_arg_pos=None,
+        description="刷B站首页推荐"
+    ),
+    "scrape_xiaohongshu": CommandSpec(
+        script="workflows/ai_xiaohongshu_homepage.py",
+        base_args=("--mode", "full"),
+        url_arg_pos=None,
+        description="刷小红书推荐"
+    )
+}
+
+
+# Confirm/cancel keyboard per command (command was validated against COMMAND_MAP)
+CONFIRM_KEYBOARDS = {
+    name: InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("✅ 确认执行", callback_data=f"confirm_{name}"),
+            InlineKeyboardButton("❌ 取消", callback_data=f"cancel_{name}")
+        ]
+    ])
+    for name in COMMAND_MAP
 }
 
 
@@ -418,11 +765,111 @@ COMMAND_DESCRIPTIONS = """你现在是一个"命令解析助手"，负责与用
 现在，请等待用户的自然语言输入，每次只对单条输入生成一份 JSON。
 """
 
+# Static part of every uncached prompt, built once
+STATIC_PROMPT_PREFIX = COMMAND_DESCRIPTIONS + "\n\n"
+
+# Reminder appended after the conversation context on every turn
+CONTEXT_REMINDER = """
+【重要提示】
+- 请记住对话中已经提供的关键信息（如视频URL）
+- 如果用户已提供视频链接，不要再问"是哪个视频"
+- 对话应该自然推进，不要重复问已回答过的问题
+- 根据已有信息直接推断用户意图
+- **必须返回纯JSON格式，不要有任何其他文字**
+"""
+
+# Parsed confirm-mode (command) replies keyed by (history, user input, context),
+# oldest first. Dialogue replies aren't cached so a repeated question gets a
+# fresh answer
+RESPONSE_CACHE_SIZE = 128
+_response_cache: "OrderedDict[tuple, Dict]" = OrderedDict()
+
+
+def _gemini_state_key(history: List[str], user_input: str, context: str) -> tuple:
+    """Cache key for a Gemini turn over the full conversation state"""
+    return (tuple(history), user_input, context)
+
+
+# Number of recent history messages resent with each Gemini turn.
+# generateContent is stateless (there is no server-side previous_response_id
+# to chain from), so the resent history is capped instead of growing per turn.
+HISTORY_WINDOW = 6
+
+# Gemini context cache for COMMAND_DESCRIPTIONS (enabled by enable_prompt_cache)
+PROMPT_CACHE_TTL = 3600  # seconds
+PROMPT_CACHE_RETRY_AFTER = 600  # seconds before retrying after a failed create
+_PROMPT_CACHE_ID: Optional[str] = None
+_PROMPT_CACHE_EXPIRES = 0.0
+
+
+def get_prompt_cache(client: GeminiClient) -> Optional[str]:
+    """Return the cached-content name for COMMAND_DESCRIPTIONS, creating it if needed"""
+    global _PROMPT_CACHE_ID, _PROMPT_CACHE_EXPIRES
+
+    if not ENABLE_PROMPT_CACHE:
+        return None
+
+    # Until the deadline, reuse the cache (refreshing a little before the
+    # server-side TTL runs out) or, after a failed create, skip it so turns
+    # don't pay an extra round trip when caching is unsupported
+    if time.time() < _PROMPT_CACHE_EXPIRES:
+        return _PROMPT_CACHE_ID
+
+    _PROMPT_CACHE_ID = client.create_cached_content(COMMAND_DESCRIPTIONS, ttl=PROMPT_CACHE_TTL)
+    if _PROMPT_CACHE_ID:
+        _PROMPT_CACHE_EXPIRES = time.time() + PROMPT_CACHE_TTL - 60
+    else:
+        _PROMPT_CACHE_EXPIRES = time.time() + PROMPT_CACHE_RETRY_AFTER
+    return _PROMPT_CACHE_ID
+
+
+def invalidate_prompt_cache():
+    """Forget the cached-content name (e.g. after the cache expired server-side)"""
+    global _PROMPT_CACHE_ID, _PROMPT_CACHE_EXPIRES
+    _PROMPT_CACHE_ID = None
+    _PROMPT_CACHE_EXPIRES = 0.0
+
+
+# Gemini errors that retrying can't fix (4xx other than 429). Both SDKs format
+# API errors as "<code> <status or message>", so the code is only trusted at
+# the start of the text; a 400 elsewhere may be a byte count or a port
+_GEMINI_FATAL_ERROR_RE = re.compile(r'^(?:400|401|403)\b|INVALID_ARGUMENT|PERMISSION_DENIED|UNAUTHENTICATED')
+GEMINI_MAX_BACKOFF = 8  # seconds
+
+
+def _extract_json_object(text: str) -> Optional[str]:
+    """Return the first balanced {...} in text, skipping braces inside strings"""
+    start = text.find('{')
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
 
 async def chat_with_gemini(user_input: str, history: List[str], context: str = "") -> Dict:
     """Conversational chat with Gemini with improved context management"""
     try:
-        client = GeminiClient(model='flash-lite', api_key=GEMINI_API_KEY)
+        client = GEMINI_CLIENT
 
         # Build prompt with improved context
         context_summary = build_context_summary(history, context)
@@ -431,97 +878,116 @@ async def chat_with_gemini(user_input: str, history: List[str], context: str = "
         if history:
             # Format as user/bot conversation for clarity
             formatted_history = []
-            for i, msg in enumerate(history[-6:]):  # Keep last 6 messages
+            for i, msg in enumerate(history[-HISTORY_WINDOW:]):  # Keep last N messages
                 role = "用户" if i % 2 == 0 else "Bot"
                 formatted_history.append(f"{role}: {msg}")
             history_text = "\n".join(formatted_history) + "\n\n"
 
         context_text = f"\n{context}" if context else ""
 
-        # Add explicit context reminder for Gemini
-        context_reminder = """
-【重要提示】
-- 请记住对话中已经提供的关键信息（如视频URL）
-- 如果用户已提供视频链接，不要再问"是哪个视频"
-- 对话应该自然推进，不要重复问已回答过的问题
-- 根据已有信息直接推断用户意图
-- **必须返回纯JSON格式，不要有任何其他文字**
-"""
+        user_prompt = "".join((context_summary, history_text, CONTEXT_REMINDER, "\n\n当前用户说：", user_input))
+
+        # Identical turns (same history, input and context) reuse the last parsed
+        # command; callers keep and modify the result, so hand out a copy
+        response_key = _gemini_state_key(history, user_input, context)
+        if response_key in _response_cache:
+            _response_cache.move_to_end(response_key)
+            logger.debug("♻️ Reusing cached Gemini response")
+            return copy.deepcopy(_response_cache[response_key])
 
-        prompt = f"{COMMAND_DESCRIPTIONS}\n\n{context_summary}{history_text}{context_reminder}\n\n当前用户说：{user_input}"
+        # With context caching the static command descriptions live server-side
+        cache_id = get_prompt_cache(client)
+        prompt = user_prompt if cache_id else STATIC_PROMPT_PREFIX + user_prompt
 
         # Debug: Print prompt (can be removed later)
-        print(f"\n🔍 [DEBUG] Prompt length: {len(prompt)} chars")
-        print(f"🔍 [DEBUG] User input: {user_input}")
+        logger.debug("🔍 Prompt length: %d chars", len(prompt))
+        logger.debug("🔍 User input: %s", user_input)
 
         # Retry mechanism for Gemini API
         max_retries = 3
         last_error = None
 
         for attempt in range(max_retries):
-            response = client.generate_content(prompt)
+            response = client.generate_content(prompt, cached_content=cache_id)
 
             if response.get('success'):
                 # Success! Break retry loop
                 break
             else:
                 last_error = response.get('error', 'Unknown error')
-                print(f"❌ [DEBUG] Gemini API attempt {attempt + 1}/{max_retries} failed: {last_error}")
+                logger.warning("❌ Gemini API attempt %d/%d failed: %s", attempt + 1, max_retries, last_error)
+                if cache_id:
+                    # Cache may have expired: fall back to the full prompt
+                    invalidate_prompt_cache()
+                    cache_id = None
+                    prompt = STATIC_PROMPT_PREFIX + user_prompt
+                elif _GEMINI_FATAL_ERROR_RE.search(str(last_error)):
+                    # Bad request / auth errors won't succeed on retry
+                    logger.warning("❌ Non-retryable Gemini error, giving up")
+                    break
                 if attempt < max_retries - 1:
-                    # Wait before retry
-                    await asyncio.sleep(1)
+                    # Jittered exponential backoff so users hitting a 429
+                    # together don't retry in lockstep
+                    delay = min(GEMINI_MAX_BACKOFF, 2 ** attempt + random.random())
+                    logger.debug("⏳ Retrying Gemini in %.1fs", delay)
+                    await asyncio.sleep(delay)
 
         if not response.get('success'):
-            print(f"❌ [DEBUG] Gemini API failed after {max_retries} attempts: {last_error}")
+            logger.error("❌ Gemini API failed after %d attempts: %s", max_retries, last_error)
             return {"mode": "error", "response": f"Gemini调用失败（已重试{max_retries}次）: {last_error}"}
 
         # Debug: Print raw response
         raw_text = response['text']
-        print(f"📥 [DEBUG] Gemini raw response length: {len(raw_text)} chars")
-        print(f"📥 [DEBUG] First 200 chars: {raw_text[:200]}")
+        logger.debug("📥 Gemini raw response length: %d chars", len(raw_text))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📥 First 200 chars: %s", raw_text[:200])
 
         # Clean and parse JSON
         text = raw_text.strip()
 
         # Try to extract JSON from various formats
         if not text:
-            print("❌ [DEBUG] Empty response from Gemini")
+            logger.warning("❌ Empty response from Gemini")
             return {"mode": "error", "response": "Gemini返回空内容"}
 
         # Remove common JSON markers
         text = text.replace("```json", "").replace("```", "").strip()
 
-        # Try to find JSON object boundaries
-        if text.startswith("{"):
-            # Good, looks like JSON
-            pass
-        else:
-            # Try to find JSON in the text
-            import re
-            json_match = re.search(r'\{[^{}]*\{.*\}[^{}]*\}', text, re.DOTALL)
-            if json_match:
-                text = json_match.group(0)
-                print(f"🔧 [DEBUG] Extracted JSON from text")
-            else:
-                print(f"❌ [DEBUG] No JSON found in response")
-                return {"mode": "error", "response": f"Gemini未返回有效JSON。原始内容: {text[:100]}..."}
+        # Cut out the first balanced JSON object (tolerates surrounding prose)
+        json_text = _extract_json_object(text)
+        if json_text is None:
+            logger.warning("❌ No JSON found in response")
+            return {"mode": "error", "response": f"Gemini未返回有效JSON。原始内容: {text[:100]}..."}
+        if json_text != text:
+            logger.debug("🔧 Extracted JSON from text")
+        text = json_text
 
         try:
-            parsed = json.loads(text)
-            print(f"✅ [DEBUG] JSON parsed successfully")
+            parsed = json_loads(text)
+            logger.debug("✅ JSON parsed successfully")
+            if isinstance(parsed, dict) and parsed.get("mode") == "confirm":
+                _response_cache[response_key] = copy.deepcopy(parsed)
+                while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                    _response_cache.popitem(last=False)
             return parsed
         except json.JSONDecodeError as e:
-            print(f"❌ [DEBUG] JSON decode error: {e}")
-            print(f"❌ [DEBUG] Text that failed to parse: {text[:500]}")
+            logger.warning("❌ JSON decode error: %s", e)
+            logger.debug("❌ Text that failed to parse: %s", text[:500])
             return {"mode": "error", "response": f"无法解析Gemini返回的JSON: {str(e)}\n\n原始内容: {text[:200]}"}
 
     except Exception as e:
-        print(f"❌ [DEBUG] Unexpected error: {type(e).__name__}: {e}")
+        logger.error("❌ Unexpected error: %s: %s", type(e).__name__, e)
         return {"mode": "error", "response": f"解析错误: {str(e)}"}
 
 
 # ==================== File Discovery ====================
 
+_URL_RE = re.compile(r'https?://\S+')
+_COMMAND_KEYWORD_RE = re.compile("|".join(
+    ['命令', '执行', '确认', 'download', 'subtitle', 'notes', 'comments', 'scrape']
+))
+
+
 def build_context_summary(history: List[str], context: str) -> str:
     """Build a summary of key information from conversation history"""
     if not history:
@@ -531,18 +997,16 @@ def build_context_summary(history: List[str], context: str) -> str:
     info_items = []
 
     # Look for URLs
-    import re
-    url_pattern = r'(https?://[^\s]+)'
-    for msg in history[-6:]:  # Check last 6 messages
-        urls = re.findall(url_pattern, msg)
-        for url in urls:
-            if url not in [item.get('url', '') for item in info_items]:
+    seen_urls = set()
+    for msg in history[-HISTORY_WINDOW:]:  # Check last N messages
+        for url in _URL_RE.findall(msg):
+            if url not in seen_urls:
+                seen_urls.add(url)
                 info_items.append(f"• 视频链接: {url}")
 
     # Look for command decisions
-    command_keywords = ['命令', '执行', '确认', 'download', 'subtitle', 'notes', 'comments', 'scrape']
     for msg in history[-4:]:  # Check last 4 messages for decisions
-        if any(kw in msg.lower() for kw in command_keywords):
+        if _COMMAND_KEYWORD_RE.search(msg.lower()):
             if msg not in info_items:
                 info_items.append(f"• 用户选择: {msg[:50]}")
 
@@ -555,103 +1019,212 @@ def build_context_summary(history: List[str], context: str) -> str:
     return ""
 
 
+# File type label by lowercase suffix
+_EXT_TYPE = {
+    '.mp4': "视频文件", '.mkv': "视频文件", '.avi': "视频文件", '.mov': "视频文件",
+    '.srt': "字幕文件", '.vtt': "字幕文件", '.ass': "字幕文件",
+    '.json': "数据文件", '.csv': "数据文件",
+    '.md': "文档文件", '.txt': "文档文件",
+    '.jpg': "图片文件", '.jpeg': "图片文件", '.png': "图片文件", '.webp': "图片文件",
+}
+
+
 def get_file_type(file_path: Path) -> str:
     """Determine file type based on path"""
-    path_str = str(file_path).lower()
-
-    if any(x in path_str for x in ['.mp4', '.mkv', '.avi', '.mov']):
-        return "视频文件"
-    elif any(x in path_str for x in ['.srt', '.vtt', '.ass']):
-        return "字幕文件"
-    elif any(x in path_str for x in ['.json', '.csv']):
-        return "数据文件"
-    elif any(x in path_str for x in ['.md', '.txt']):
-        return "文档文件"
-    elif any(x in path_str for x in ['.jpg', '.jpeg', '.png', '.webp']):
-        return "图片文件"
-    else:
-        return "其他文件"
+    return _EXT_TYPE.get(file_path.suffix.lower(), "其他文件")
+
+
+# Output directories scanned for files produced by a command
+GENERATED_FILE_DIRS = [
+    "test_downloads",
+    "downloaded_videos",
+    "output",
+    "MediaCrawler/bilibili_subtitles",
+    "learning_notes",
+    "bili_comments_output",
+    "xhs_comments_output",
+    "xhs_analysis",
+    "xhs_images",
+]
+
+# Commands whose scripts write to known directories only search those;
+# anything else (the auto_content_workflow family) searches all of the above
+COMMAND_OUTPUT_DIRS = {
+    "scrape_bilibili": ["MediaCrawler/bilibili_subtitles"],
+    "scrape_xiaohongshu": ["output"],
+}
+
+# Recently created/modified files reported by watchdog: path -> event time,
+# oldest first. Directories in _WATCHED_DIRS are served from here instead of
+# being walked on every command.
+RECENT_FILES_LIMIT = 1024
+_recent_files: "OrderedDict[str, float]" = OrderedDict()
+_recent_files_lock = threading.Lock()
+_WATCHED_DIRS: set = set()
+
+
+def _record_recent_file(path: str):
+    """Move path to the newest end of the index (called from the observer thread)"""
+    with _recent_files_lock:
+        _recent_files[path] = time.time()
+        _recent_files.move_to_end(path)
+        while len(_recent_files) > RECENT_FILES_LIMIT:
+            _recent_files.popitem(last=False)
+
+
+if HAS_WATCHDOG:
+    class _GeneratedFileHandler(FileSystemEventHandler):
+        """Feed file events under the output directories into the index"""
+
+        def on_created(self, event):
+            if not event.is_directory:
+                _record_recent_file(event.src_path)
+
+        def on_modified(self, event):
+            if not event.is_directory:
+                _record_recent_file(event.src_path)
+
+        def on_moved(self, event):
+            # Downloaders write to a temp name and rename on completion
+            if not event.is_directory:
+                _record_recent_file(event.dest_path)
+
+
+def start_generated_file_index(project_root: Path):
+    """Start watching the output directories; returns the observer or None"""
+    if not HAS_WATCHDOG:
+        return None
+
+    observer = Observer()
+    handler = _GeneratedFileHandler()
+    for name in GENERATED_FILE_DIRS:
+        dir_path = project_root / name
+        # Directories that don't exist yet keep using the directory walk
+        if dir_path.is_dir():
+            observer.schedule(handler, str(dir_path), recursive=True)
+            _WATCHED_DIRS.add(str(dir_path))
+    observer.start()
+    return observer
+
+
+def _indexed_recent(cutoff: float, roots: tuple):
+    """Yield (path, name, stat_result) for indexed files under roots touched at or after cutoff"""
+    with _recent_files_lock:
+        snapshot = list(_recent_files.items())
+
+    for path, event_time in reversed(snapshot):
+        if event_time < cutoff:
+            break
+        if not path.startswith(roots):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Deleted or renamed since the event
+            continue
+        if stat.S_ISREG(st.st_mode) and st.st_mtime >= cutoff:
+            yield path, os.path.basename(path), st
+
+
+def _walk_recent(root: Path, cutoff: float):
+    """Yield (path, name, stat_result) for regular files under root modified at or after cutoff"""
+    stack = [str(root)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            continue
+                        st = entry.stat()  # One stat per entry, cached on the DirEntry
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode) and st.st_mtime >= cutoff:
+                        yield entry.path, entry.name, st
+        except OSError:
+            # Missing or unreadable directory
+            continue
 
 
 def find_generated_files(project_root: Path, command: str = None) -> List[Dict]:
     """Find files generated by recent command execution (within last 15 minutes)"""
     now = time.time()
+    ai_results = []
     results = []
 
-    # Directories to search based on command
-    search_dirs = [
-        project_root / "test_downloads",
-        project_root / "downloaded_videos",
-        project_root / "output",
-        project_root / "MediaCrawler" / "bilibili_subtitles",
-        project_root / "learning_notes",
-        project_root / "bili_comments_output",
-        project_root / "xhs_comments_output",
-        project_root / "xhs_analysis",
-        project_root / "xhs_images",
-    ]
+    cutoff = now - 900
+
+    # Watched directories come from the event index; the rest are walked
+    dirs = [str(project_root / name) for name in COMMAND_OUTPUT_DIRS.get(command, GENERATED_FILE_DIRS)]
+    candidates = []
+    indexed_roots = tuple(d + os.sep for d in dirs if d in _WATCHED_DIRS)
+    if indexed_roots:
+        candidates.append(_indexed_recent(cutoff, indexed_roots))
+    for dir_path in dirs:
+        if dir_path not in _WATCHED_DIRS:
+            candidates.append(_walk_recent(Path(dir_path), cutoff))
 
     # For scrape commands, also search for AI summary files specifically
     ai_summary_pattern = None
+    summary_dir = None
     if command == "scrape_bilibili":
         ai_summary_pattern = "homepage_*_AI总结.md"
+        summary_dir = str(project_root / "MediaCrawler" / "bilibili_subtitles")
     elif command == "scrape_xiaohongshu":
         ai_summary_pattern = "xiaohongshu_homepage_*_AI报告.md"
+        summary_dir = str(project_root / "output" / "xiaohongshu_homepage")
+
+    # AI summary files (priority, 10 minutes) are tagged by location and name,
+    # everything else modified within 15 minutes is a regular result
+    for source in candidates:
+        for path, name, st in source:
+            size_mb = st.st_size / 1024 / 1024
+            size_str = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{size_mb*1024:.0f} KB"
+
+            if (ai_summary_pattern
+                    and (now - st.st_mtime) < 600
+                    and os.path.dirname(path) == summary_dir
+                    and fnmatch.fnmatch(name, ai_summary_pattern)):
+                ai_results.append({
+                    "path": path,
+                    "name": name,
+                    "type": "AI分析报告",
+                    "size_str": size_str,
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns,
+                    "is_ai_summary": True  # Mark as AI summary
+                })
+            else:
+                results.append({
+                    "path": path,
+                    "name": name,
+                    "type": get_file_type(Path(path)),
+                    "size_str": size_str,
+                    "size": st.st_size,
+                    "mtime_ns": st.st_mtime_ns
+                })
 
-    # First, look for AI summary files (priority)
-    if ai_summary_pattern:
-        if command == "scrape_bilibili":
-            summary_dir = project_root / "MediaCrawler" / "bilibili_subtitles"
-        else:  # scrape_xiaohongshu
-            summary_dir = project_root / "output" / "xiaohongshu_homepage"
-
-        if summary_dir.exists():
-            for file in summary_dir.glob(ai_summary_pattern):
-                if file.is_file() and (now - file.stat().st_mtime) < 600:  # 10 minutes for scrape commands
-                    size = file.stat().st_size
-                    size_mb = size / 1024 / 1024
-                    size_str = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{size_mb*1024:.0f} KB"
-
-                    results.insert(0, {  # Insert at beginning (priority)
-                        "path": str(file),
-                        "name": file.name,
-                        "type": "AI分析报告",
-                        "size_str": size_str,
-                        "is_ai_summary": True  # Mark as AI summary
-                    })
-
-    # Then search for other files
-    for dir_path in search_dirs:
-        if not dir_path.exists():
-            continue
-
-        for file in dir_path.rglob("*"):
-            if file.is_file():
-                # Check if file was created recently (within 15 minutes)
-                if (now - file.stat().st_mtime) < 900:
-                    size = file.stat().st_size
-                    size_mb = size / 1024 / 1024
-                    size_str = f"{size_mb:.2f} MB" if size_mb >= 1 else f"{size_mb*1024:.0f} KB"
+    return ai_results + results
 
-                    # Skip if it's already in results (AI summary)
-                    if any(r['path'] == str(file) for r in results):
-                        continue
 
-                    results.append({
-                        "path": str(file),
-                        "name": file.name,
-                        "type": get_file_type(file),
-                        "size_str": size_str
-                    })
+# Formatted AI summaries keyed by (path, st_mtime_ns, st_size), oldest first
+SUMMARY_CACHE_SIZE = 64
+_summary_cache: "OrderedDict[tuple, str]" = OrderedDict()
 
-    return results
 
-
-def read_ai_summary(file_path: Path) -> str:
+async def read_ai_summary(file_path: Path) -> str:
     """Read AI summary file and return its content"""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        st = os.stat(file_path)
+        key = (str(file_path), st.st_mtime_ns, st.st_size)
+        if key in _summary_cache:
+            _summary_cache.move_to_end(key)
+            return _summary_cache[key]
+
+        # Only the head is shown, so never read more than the truncation needs
+        async with aiofiles.open(file_path, 'r', encoding='utf-8') as f:
+            content = await f.read(3501)
         # Limit to 4000 chars for Telegram message
         # Use smaller limit to account for Markdown escaping
         if len(content) > 3500:
@@ -661,26 +1234,25 @@ def read_ai_summary(file_path: Path) -> str:
         # Check if escaped content is still too long
         if len(content) > 4000:
             content = content[:3900] + "\n\n...(内容过长，已截断，完整内容请查看文件)"
+
+        _summary_cache[key] = content
+        while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+            _summary_cache.popitem(last=False)
         return content
     except Exception as e:
         return f"无法读取AI报告: {str(e)}"
 
 
 async def parse_file_selection(user_input: str, available_files: List[Dict]) -> List[int]:
-    """Parse user's file selection using Gemini"""
+    """Parse user's file selection, using Gemini only for free-form input"""
     if not available_files:
         return []
 
-    # Check for exit commands first (simple keywords)
-    exit_keywords = ['完成', '结束', '退出', 'exit', 'done', 'finish', 'quit', 'no', '不需要', 'cancel']
-    user_input_lower = user_input.lower().strip()
-    if any(kw in user_input_lower for kw in exit_keywords):
-        return [-1]  # Special value: -1 means exit file selection
+    local_selection = match_file_selection(user_input, available_files)
+    if local_selection is not None:
+        return local_selection
 
-    file_list = "\n".join(
-        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-        for i, f in enumerate(available_files)
-    )
+    file_list = format_file_list(available_files)
 
     prompt = f"""我生成了以下文件：
 
@@ -695,8 +1267,7 @@ async def parse_file_selection(user_input: str, available_files: List[Dict]) ->
 """
 
     try:
-        client = GeminiClient(model='flash-lite', api_key=GEMINI_API_KEY)
-        response = client.generate_content(prompt)
+        response = GEMINI_CLIENT.generate_content(prompt)
 
         if response.get('success'):
             text = response['text'].strip()
@@ -713,9 +1284,49 @@ async def parse_file_selection(user_input: str, available_files: List[Dict]) ->
         return []
 
 
+# JSON files below this size (bytes) are sent inline as formatted text
+JSON_INLINE_LIMIT = 4000
+
+
+# Telegram accepts at most 10 items per sendMediaGroup call
+MEDIA_GROUP_SIZE = 10
+# Albums uploaded at once per selection, to stay under per-chat rate limits
+UPLOAD_CONCURRENCY = 4
+
+# Bot API upload limit for documents (bytes)
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+
+def upload_too_large_text(file_info: Dict) -> str:
+    """Reply for a file over TELEGRAM_UPLOAD_LIMIT"""
+    return f"⚠️ 文件过大（{file_info['size_str']}），超过 Telegram 50 MB 上传限制: {file_info['name']}"
+
+
+async def _send_document_group(context: ContextTypes.DEFAULT_TYPE, chat_id: int, group: List[tuple]):
+    """Send (file_info, caption) pairs as one album, or a single document"""
+    # PTB opens Path inputs itself, so no file handles are held in the handler
+    if len(group) == 1:
+        file_info, caption = group[0]
+        await context.bot.send_document(
+            chat_id=chat_id,
+            document=Path(file_info["path"]),
+            filename=file_info["name"],
+            caption=caption
+        )
+    else:
+        await context.bot.send_media_group(
+            chat_id=chat_id,
+            media=[
+                InputMediaDocument(Path(file_info["path"]), filename=file_info["name"], caption=caption)
+                for file_info, caption in group
+            ]
+        )
+
+
 async def send_selected_files(update: Update, context: ContextTypes.DEFAULT_TYPE,
                            file_indices: List[int], available_files: List[Dict]):
     """Send selected files to user with JSON file handling"""
+    documents = []  # (file_info, caption) to upload after the inline messages
     for idx in file_indices:
         if idx < len(available_files):
             file_info = available_files[idx]
@@ -723,95 +1334,148 @@ async def send_selected_files(update: Update, context: ContextTypes.DEFAULT_TYPE
             file_name = file_info["name"]
             file_ext = file_name.lower().split('.')[-1] if '.' in file_name else ''
 
-            if file_path.exists():
+            # Entries from find_generated_files carry their stat results
+            size = file_info.get("size")
+            if size is not None or file_path.exists():
                 try:
-                    # Check if it's a JSON file
-                    if file_ext == 'json':
-                        # Read JSON as text
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            json_content = f.read()
-
-                        # Try to format JSON (if not too large)
+                    caption = f"{file_info['type']} - {file_info['size_str']}"
+
+                    # Small JSON files are shown inline; anything larger is
+                    # uploaded as a document instead of being split into messages
+                    if size is None:
+                        size = file_path.stat().st_size
+                    if size > TELEGRAM_UPLOAD_LIMIT:
+                        await context.bot.send_message(
+                            chat_id=update.effective_chat.id,
+                            text=upload_too_large_text(file_info)
+                        )
+                        continue
+                    if file_ext == 'json' and size < JSON_INLINE_LIMIT:
                         try:
-                            # Format for better readability
-                            formatted_json = json.dumps(json.loads(json_content), ensure_ascii=False, indent=2)
+                            async with aiofiles.open(file_path, 'rb') as f:
+                                raw = await f.read()
+                            formatted_json = json_dumps(json_loads(raw), indent=True)
+                        except (json.JSONDecodeError, UnicodeDecodeError):
+                            formatted_json = None
+                            caption = f"❌ JSON 格式错误，已作为文件发送\n{caption}"
+
+                        if formatted_json is not None:
                             # Escape special characters to avoid Markdown parsing errors
                             formatted_json = escape_markdown(formatted_json)
-
-                            # Calculate total message length with headers
-                            header_length = len(f"📄 **JSON文件**\n\n**文件名**: {file_info['name']}\n**大小**: {file_info['size_str']}\n\n---\n\n```json\n\n```")
-                            total_length = header_length + len(formatted_json)
-
-                            if total_length < 4000:
+                            text = (f"📄 **JSON文件**\n\n"
+                                    f"**文件名**: {file_info['name']}\n"
+                                    f"**大小**: {file_info['size_str']}\n"
+                                    f"---\n"
+                                    f"```json\n{formatted_json}\n```")
+                            # Pretty-printing and escaping can push it over the limit
+                            if len(text) < 4000:
                                 await context.bot.send_message(
                                     chat_id=update.effective_chat.id,
-                                    text=f"📄 **JSON文件**\n\n"
-                                        f"**文件名**: {file_info['name']}\n"
-                                        f"**大小**: {file_info['size_str']}\n"
-                                        f"---\n"
-                                        f"```json\n{formatted_json}\n```"
+                                    text=text
                                 )
-                            else:
-                                # Formatted JSON is too long, send raw JSON in chunks
-                                # Split into chunks and send multiple messages
-                                chunk_size = 3500  # Leave room for headers
-                                chunks = [json_content[i:i+chunk_size]
-                                         for i in range(0, len(json_content), chunk_size)]
+                                continue
 
-                                await context.bot.send_message(
-                                    chat_id=update.effective_chat.id,
-                                    text=f"📄 **JSON文件 (分片发送)**\n\n"
-                                        f"**文件名**: {file_info['name']}\n"
-                                        f"**大小**: {file_info['size_str']}\n"
-                                        f"**总长度**: {len(json_content):,} 字符\n"
-                                        f"**分**: {len(chunks)} 部分"
-                                )
-
-                                for i, chunk in enumerate(chunks, 1):
-                                    # Escape special characters in each chunk
-                                    escaped_chunk = escape_markdown(chunk)
-                                    # Check if escaped chunk is too long
-                                    if len(escaped_chunk) > 3900:
-                                        escaped_chunk = escaped_chunk[:3900] + "\n\n...(已截断)"
-                                    await context.bot.send_message(
-                                        chat_id=update.effective_chat.id,
-                                        text=f"📄 第 {i}/{len(chunks)} 部分：\n\n```json\n{escaped_chunk}\n```"
-                                    )
-                        except json.JSONDecodeError:
-                            # Invalid JSON, send as plain text
-                            await context.bot.send_document(
-                                chat_id=update.effective_chat.id,
-                                document=open(file_path, 'rb'),
-                                filename=file_info["name"],
-                                caption=f"❌ JSON 格式错误，已作为文件发送\n{file_info.get('type', '文件')} - {file_info['size_str']}"
-                            )
-                    else:
-                        # Non-JSON file, send as document
-                        with open(file_path, "rb") as f:
-                            await context.bot.send_document(
-                                chat_id=update.effective_chat.id,
-                                document=f,
-                                filename=file_info["name"],
-                                caption=f"{file_info['type']} - {file_info['size_str']}"
-                            )
+                    documents.append((file_info, caption))
                 except Exception as e:
                     await context.bot.send_message(
                         chat_id=update.effective_chat.id,
                         text=f"⚠️ 发送文件失败: {file_info['name']}\n错误: {str(e)}"
                     )
 
+    # Upload documents in albums of up to 10, a few albums at a time
+    groups = [documents[i:i + MEDIA_GROUP_SIZE] for i in range(0, len(documents), MEDIA_GROUP_SIZE)]
+    upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+    async def send_group(group: List[tuple]):
+        async with upload_slots:
+            await _send_document_group(context, update.effective_chat.id, group)
+
+    results = await asyncio.gather(*(send_group(group) for group in groups), return_exceptions=True)
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            names = ", ".join(file_info["name"] for file_info, _ in group)
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text=f"⚠️ 发送文件失败: {names}\n错误: {str(result)}"
+            )
+
+
+async def _reply_all(replies: List):
+    """Await reply coroutines one by one so Telegram shows them in order; one failure doesn't skip the rest"""
+    for reply in replies:
+        try:
+            await reply
+        except Exception as e:
+            logger.warning("⚠️ [REPLY] Failed to send message: %s: %s", type(e).__name__, e)
+
+
+def format_file_list(files: List[Dict]) -> str:
+    """Numbered "name (type, size)" lines, matching the 1-based numbers users reply with"""
+    return "\n".join(
+        f"{i}. {f['name']} ({f['type']}, {f['size_str']})"
+        for i, f in enumerate(files, 1)
+    )
+
+
+# Markers scripts print when they skip work that was already done
+_VIDEO_EXISTS_RE = re.compile("视频已存在|跳过下载")
+_CONTENT_EXISTS_RE = re.compile("笔记已存在|skip", re.IGNORECASE)
+
+
+def skipped_work_note(raw_output: str) -> str:
+    """Suffix for the completion message when the script skipped existing output, or empty"""
+    if _VIDEO_EXISTS_RE.search(raw_output):
+        return "\n📹 视频已下载，跳过重复下载。"
+    if _CONTENT_EXISTS_RE.search(raw_output):
+        return "\n📝 内容已存在，跳过重复处理。"
+    return ""
+
+
+def output_tail_html(raw_output: str) -> str:
+    """Last 1000 chars of command output as an escaped HTML <pre> block
+
+    HTML escaping is exact, unlike legacy Markdown where a stray ``` or _ in
+    script output makes Telegram reject the whole message.
+    """
+    return f"<pre>{html.escape(raw_output[-1000:])}</pre>"
+
+
+# Playwright noise like "21 elements. Proceeding with the first one: <div..."
+_WARN_RE = re.compile(r'^\d+\s+elements\. Proceeding with the first one:')
+
+
+def _filter_stderr(text: str) -> str:
+    """Drop Playwright element warnings and HTML fragments from script stderr"""
+    out = []
+    append = out.append
+    for line in text.splitlines():
+        if 'data-v-' in line or '<div' in line:
+            continue
+        # Only lines starting with a digit can match, skip the regex otherwise
+        if line[:1].isdigit() and _WARN_RE.match(line):
+            continue
+        append(line)
+    return '\n'.join(out)
+
 
 # ==================== Bot Commands ====================
 
+def require_auth(handler):
+    """Reply "unauthorized" instead of running handler for users outside ALLOWED_USERS"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if ALLOWED_USERS and update.effective_user.id not in ALLOWED_USERS:
+            await update.message.reply_text("❌ 未授权用户")
+            return
+        return await handler(update, context)
+    return wrapper
+
+
+@require_auth
 async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Stop currently running process for user"""
     user_id = update.effective_user.id
 
-    # Check user authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
     # Get currently running process
     process = get_user_process(user_id)
     state = get_user_state(user_id)
@@ -821,16 +1485,15 @@ async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        # Try to terminate the process
-        if hasattr(process, 'terminate'):
-            process.terminate()
-            await asyncio.sleep(1)  # Give it a moment to terminate gracefully
-
-        # If still running, kill it
-        if hasattr(process, 'poll') and process.poll() is None:
-            if hasattr(process, 'kill'):
-                process.kill()
-                await asyncio.sleep(0.5)
+        # Try to terminate the process, give it a moment to exit gracefully
+        if process.returncode is None:
+            stop_process_group(process)
+            try:
+                await asyncio.wait_for(process.wait(), timeout=1.0)
+            except asyncio.TimeoutError:
+                # Still running, kill it
+                stop_process_group(process, force=True)
+                await process.wait()
 
         # Clear process and state
         clear_user_process(user_id)
@@ -849,19 +1512,8 @@ async def cmd_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state.clear()
 
 
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start command"""
-    user_id = update.effective_user.id
-
-    # Check user authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
-    # Clear conversation state
-    get_user_state(user_id).clear()
-
-    help_text = """👋 你好！我是**智能内容处理 Bot**
+# /start and /help message, built once at import
+HELP_TEXT = """👋 你好！我是**智能内容处理 Bot**
 
 我会通过对话理解你的需求，自动执行对应的命令。
 
@@ -978,67 +1630,35 @@ Bot: 📄 **文档文件**
 
 ⚡ **快速操作**
 """
-    # Quick action buttons
-    keyboard = InlineKeyboardMarkup([
-        [
-            InlineKeyboardButton("📊 字幕分析", callback_data="btn_subtitle"),
-            InlineKeyboardButton("📝 学习笔记", callback_data="btn_notes")
-        ],
-        [
-            InlineKeyboardButton("🎬 刷B站推荐", callback_data="btn_bili"),
-            InlineKeyboardButton("🌸 刷小红书", callback_data="btn_xhs")
-        ]
-    ])
-    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
 
+# Quick action buttons shown under the help text
+START_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📊 字幕分析", callback_data="btn_subtitle"),
+        InlineKeyboardButton("📝 学习笔记", callback_data="btn_notes")
+    ],
+    [
+        InlineKeyboardButton("🎬 刷B站推荐", callback_data="btn_bili"),
+        InlineKeyboardButton("🌸 刷小红书", callback_data="btn_xhs")
+    ]
+])
 
-# ==================== Quick Button Commands ====================
 
-async def cmd_btn_subtitle(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """B站字幕分析 - with model selection"""
+@require_auth
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start command"""
     user_id = update.effective_user.id
 
-    # Check authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
-    # Check if URL is provided
-    url_arg = " ".join(context.args) if context.args else ""
-
-    # Show model selection buttons
-    keyboard = InlineKeyboardMarkup([
-        [
-            [
-                InlineKeyboardButton("🔥 Flash Lite", callback_data=f"subtitle_flash-lite_{url_arg}"),
-                InlineKeyboardButton("⚡ Flash", callback_data=f"subtitle_flash_{url_arg}"),
-                InlineKeyboardButton("💎 Pro", callback_data=f"subtitle_pro_{url_arg}")
-            ],
-            [
-                InlineKeyboardButton("📝 仅字幕分析", callback_data=f"subtitle_only_{url_arg}"),
-                InlineKeyboardButton("💬 字幕+评论(50条)", callback_data=f"subtitle_c50_{url_arg}"),
-                InlineKeyboardButton("💬 字幕+评论(100条)", callback_data=f"subtitle_c100_{url_arg}")
-            ]
-        ]
-    ])
+    # Clear conversation state
+    get_user_state(user_id).clear()
 
-    if url_arg:
-        help_text = f"""🎯 **B站字幕分析**
+    await update.message.reply_text(HELP_TEXT, reply_markup=START_KEYBOARD, parse_mode="Markdown")
 
-**选择模型：**
-• 🔥 Flash Lite（快速，默认）
-• ⚡ Flash（中等）
-• 💎 Pro（高级）
 
-**选择模式：**
-• 📝 仅字幕分析
-• 💬 字幕+评论（50条）
-• 💬 字幕+评论（100条）
+# ==================== Quick Button Commands ====================
 
-视频链接：`{url_arg}`
-"""
-    else:
-        help_text = """🎯 **B站字幕分析**
+# /subtitle menu text, with or without the URL given as an argument
+SUBTITLE_MENU_HEAD = """🎯 **B站字幕分析**
 
 **选择模型：**
 • 🔥 Flash Lite（快速，默认）
@@ -1050,55 +1670,40 @@ async def cmd_btn_subtitle(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 💬 字幕+评论（50条）
 • 💬 字幕+评论（100条）
 
-如需指定视频链接，请使用：`/subtitle <视频链接>`
 """
-    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
+SUBTITLE_MENU_URL = SUBTITLE_MENU_HEAD + "视频链接：`{url}`\n"
+SUBTITLE_MENU_NO_URL = SUBTITLE_MENU_HEAD + "如需指定视频链接，请使用：`/subtitle <视频链接>`\n"
 
 
-async def cmd_btn_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """生成学习笔记 - with common options"""
+@require_auth
+async def cmd_btn_subtitle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """B站字幕分析 - with model selection"""
     user_id = update.effective_user.id
 
-    # Check authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
+    # Check if URL is provided; buttons carry a short token instead of the URL
     url_arg = " ".join(context.args) if context.args else ""
+    token = get_user_state(user_id).url_token(url_arg)
 
-    # Show options
+    # Show model selection buttons
     keyboard = InlineKeyboardMarkup([
         [
-            [
-                InlineKeyboardButton("✨ 默认", callback_data=f"notes_default_{url_arg}"),
-                InlineKeyboardButton("📸 8关键帧", callback_data=f"notes_k8_{url_arg}"),
-                InlineKeyboardButton("📸 12关键帧", callback_data=f"notes_k12_{url_arg}")
-            ],
-            [
-                InlineKeyboardButton("📸 16关键帧", callback_data=f"notes_k16_{url_arg}"),
-                InlineKeyboardButton("⚡ Flash模型", callback_data=f"notes_flash_{url_arg}"),
-                InlineKeyboardButton("💎 Pro模型", callback_data=f"notes_pro_{url_arg}")
-            ],
-            [
-                InlineKeyboardButton("🎨 自定义", callback_data=f"notes_custom_{url_arg}")
-            ]
+            InlineKeyboardButton("🔥 Flash Lite", callback_data=f"subtitle_flash-lite_{token}"),
+            InlineKeyboardButton("⚡ Flash", callback_data=f"subtitle_flash_{token}"),
+            InlineKeyboardButton("💎 Pro", callback_data=f"subtitle_pro_{token}")
+        ],
+        [
+            InlineKeyboardButton("📝 仅字幕分析", callback_data=f"subtitle_only_{token}"),
+            InlineKeyboardButton("💬 字幕+评论(50条)", callback_data=f"subtitle_c50_{token}"),
+            InlineKeyboardButton("💬 字幕+评论(100条)", callback_data=f"subtitle_c100_{token}")
         ]
     ])
 
-    if url_arg:
-        help_text = f"""📝 **生成学习笔记**
+    help_text = SUBTITLE_MENU_URL.format(url=url_arg) if url_arg else SUBTITLE_MENU_NO_URL
+    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
 
-**快速选项：**
-• ✨ 默认设置（flash-lite，智能检测）
-• 📸 关键帧数量（8/12/16帧）
-• ⚡ Flash 模型（更快）
-• 💎 Pro 模型（更准确）
-• 🎨 自定义参数
 
-视频链接：`{url_arg}`
-"""
-    else:
-        help_text = """📝 **生成学习笔记**
+# /notes menu text, with or without the URL given as an argument
+NOTES_MENU_HEAD = """📝 **生成学习笔记**
 
 **快速选项：**
 • ✨ 默认设置（flash-lite，智能检测）
@@ -1107,37 +1712,42 @@ async def cmd_btn_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • 💎 Pro 模型（更准确）
 • 🎨 自定义参数
 
-如需指定视频链接，请使用：`/notes <视频链接>`
 """
-    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
+NOTES_MENU_URL = NOTES_MENU_HEAD + "视频链接：`{url}`\n"
+NOTES_MENU_NO_URL = NOTES_MENU_HEAD + "如需指定视频链接，请使用：`/notes <视频链接>`\n"
 
 
-async def cmd_btn_bili(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """刷B站推荐"""
+@require_auth
+async def cmd_btn_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """生成学习笔记 - with common options"""
     user_id = update.effective_user.id
 
-    # Check authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
+    url_arg = " ".join(context.args) if context.args else ""
+    token = get_user_state(user_id).url_token(url_arg)
 
     # Show options
     keyboard = InlineKeyboardMarkup([
         [
-            [
-                InlineKeyboardButton("⚡ 刷10次", callback_data="bili_10"),
-                InlineKeyboardButton("📊 刷20次", callback_data="bili_20"),
-                InlineKeyboardButton("📊 刷30次", callback_data="bili_30")
-            ],
-            [
-                InlineKeyboardButton("📊 刷50次", callback_data="bili_50"),
-                InlineKeyboardButton("📊 刷100次", callback_data="bili_100"),
-                InlineKeyboardButton("✏️ 自定义", callback_data="bili_custom")
-            ]
+            InlineKeyboardButton("✨ 默认", callback_data=f"notes_default_{token}"),
+            InlineKeyboardButton("📸 8关键帧", callback_data=f"notes_k8_{token}"),
+            InlineKeyboardButton("📸 12关键帧", callback_data=f"notes_k12_{token}")
+        ],
+        [
+            InlineKeyboardButton("📸 16关键帧", callback_data=f"notes_k16_{token}"),
+            InlineKeyboardButton("⚡ Flash模型", callback_data=f"notes_flash_{token}"),
+            InlineKeyboardButton("💎 Pro模型", callback_data=f"notes_pro_{token}")
+        ],
+        [
+            InlineKeyboardButton("🎨 自定义", callback_data=f"notes_custom_{token}")
         ]
     ])
 
-    help_text = """🎬 **刷B站首页推荐**
+    help_text = NOTES_MENU_URL.format(url=url_arg) if url_arg else NOTES_MENU_NO_URL
+    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
+
+
+# /bili menu text and keyboard
+BILI_MENU_TEXT = """🎬 **刷B站首页推荐**
 
 **选择刷新次数：**
 • ⚡ 刷10次（快速）
@@ -1151,35 +1761,28 @@ async def cmd_btn_bili(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💡 如需自定义（模型、视频数），请使用：`/ask 刷B站首页 <参数>`
 """
-    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
-
+BILI_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("⚡ 刷10次", callback_data="bili_10"),
+        InlineKeyboardButton("📊 刷20次", callback_data="bili_20"),
+        InlineKeyboardButton("📊 刷30次", callback_data="bili_30")
+    ],
+    [
+        InlineKeyboardButton("📊 刷50次", callback_data="bili_50"),
+        InlineKeyboardButton("📊 刷100次", callback_data="bili_100"),
+        InlineKeyboardButton("✏️ 自定义", callback_data="bili_custom")
+    ]
+])
 
-async def cmd_btn_xhs(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """刷小红书推荐"""
-    user_id = update.effective_user.id
 
-    # Check authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
+@require_auth
+async def cmd_btn_bili(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """刷B站推荐"""
+    await update.message.reply_text(BILI_MENU_TEXT, reply_markup=BILI_KEYBOARD, parse_mode="Markdown")
 
-    # Show options
-    keyboard = InlineKeyboardMarkup([
-        [
-            [
-                InlineKeyboardButton("⚡ 刷10次", callback_data="xhs_10"),
-                InlineKeyboardButton("📊 刷20次", callback_data="xhs_20"),
-                InlineKeyboardButton("📊 刷30次", callback_data="xhs_30")
-            ],
-            [
-                InlineKeyboardButton("📊 刷50次", callback_data="xhs_50"),
-                InlineKeyboardButton("📊 刷100次", callback_data="xhs_100"),
-                InlineKeyboardButton("✏️ 自定义", callback_data="xhs_custom")
-            ]
-        ]
-    ])
 
-    help_text = """🌸 **刷小红书推荐**
+# /xhs menu text and keyboard
+XHS_MENU_TEXT = """🌸 **刷小红书推荐**
 
 **选择刷新次数：**
 • ⚡ 刷10次（快速）
@@ -1193,19 +1796,39 @@ async def cmd_btn_xhs(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 💡 如需自定义（模型、笔记数），请使用：`/ask 刷小红书 <参数>`
 """
-    await update.message.reply_text(help_text, reply_markup=keyboard, parse_mode="Markdown")
+XHS_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("⚡ 刷10次", callback_data="xhs_10"),
+        InlineKeyboardButton("📊 刷20次", callback_data="xhs_20"),
+        InlineKeyboardButton("📊 刷30次", callback_data="xhs_30")
+    ],
+    [
+        InlineKeyboardButton("📊 刷50次", callback_data="xhs_50"),
+        InlineKeyboardButton("📊 刷100次", callback_data="xhs_100"),
+        InlineKeyboardButton("✏️ 自定义", callback_data="xhs_custom")
+    ]
+])
 
 
+@require_auth
+async def cmd_btn_xhs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """刷小红书推荐"""
+    await update.message.reply_text(XHS_MENU_TEXT, reply_markup=XHS_KEYBOARD, parse_mode="Markdown")
+
+
+# custom_input_type -> (menu title, COMMAND_MAP command, max-items flag) for custom refresh counts
+CUSTOM_COUNT_WORKFLOWS = {
+    "bili_count": ("🎬 **刷B站首页推荐**", "scrape_bilibili", "--max-videos"),
+    "xhs_count": ("🌸 **刷小红书推荐**", "scrape_xiaohongshu", "--max-notes"),
+}
+
+
+@require_auth
 async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle custom input from user (e.g., custom refresh count)"""
     user_id = update.effective_user.id
     state = get_user_state(user_id)
 
-    # Check authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
     # Only process if we're in custom_input phase
     if state.phase != "custom_input":
         return
@@ -1216,8 +1839,9 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
     # Handle custom input based on type
     custom_type = state.custom_input_type
 
-    if custom_type == "bili_count":
-        # B站自定义刷新次数
+    if custom_type in CUSTOM_COUNT_WORKFLOWS:
+        # 自定义刷新次数
+        title, command, max_items_flag = CUSTOM_COUNT_WORKFLOWS[custom_type]
         try:
             count = int(user_input)
             if count <= 0:
@@ -1228,10 +1852,10 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
                 return
 
             # Execute command with custom count
-            args = ["--mode", "full", "--refresh-count", str(count), "--max-videos", "50", "--model", "flash-lite"]
+            args = ["--mode", "full", "--refresh-count", str(count), max_items_flag, "50", "--model", "flash-lite"]
 
             await update.message.reply_text(
-                f"✅ 已选择：刷新 {count} 次\n\n🎬 **刷B站首页推荐**\n\n⏳ 正在执行...",
+                f"✅ 已选择：刷新 {count} 次\n\n{title}\n\n⏳ 正在执行...",
                 parse_mode="Markdown"
             )
 
@@ -1239,43 +1863,36 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             try:
                 process = await asyncio.create_subprocess_exec(
                     sys.executable,
-                    str(PROJECT_ROOT / "workflows" / "ai_bilibili_homepage.py"),
+                    COMMAND_MAP[command].script_path,
                     *args,
                     stdout=asyncio.subprocess.PIPE,
                     stderr=asyncio.subprocess.PIPE,
                     cwd=str(PROJECT_ROOT),
-                    env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                    env=SUBPROCESS_ENV,
+                    start_new_session=True
                 )
 
-                stdout, stderr = await process.communicate()
-                stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-                stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+                # Save process reference
+                set_user_process(user_id, process)
+
+                stdout_text, stderr_text = await read_process_output(process)
+                clear_user_process(user_id)
                 raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
 
                 if process.returncode == 0:
-                    await update.message.reply_text("✅ 执行完成！")
-
                     # Find and send generated files
-                    generated = find_generated_files(PROJECT_ROOT, "scrape_bilibili")
+                    generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, command)
                     if generated:
-                        state.generated_files = generated
-                        file_list = "\n".join(
-                            f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                            for i, f in enumerate(generated)
-                        )
+                        state.offer_files(generated)
+                        file_list = format_file_list(generated)
 
                         await update.message.reply_text(
                             f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
                             f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
                         )
-                        state.phase = "file_select"
                     else:
                         # Check if output mentions "video already exists" or "skipped download"
-                        video_exists_msg = ""
-                        if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                            video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                        elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                            video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                        video_exists_msg = skipped_work_note(raw_output)
 
                         if video_exists_msg:
                             await update.message.reply_text(
@@ -1286,12 +1903,13 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
                         state.clear()
                 else:
                     await update.message.reply_text(
-                        f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                        parse_mode="Markdown"
+                        f"⚠️ 执行完成，但有警告\n\n{output_tail_html(raw_output)}",
+                        parse_mode="HTML"
                     )
                     state.clear()
 
             except Exception as e:
+                clear_user_process(user_id)
                 await update.message.reply_text(f"❌ 执行错误: {str(e)}")
                 state.clear()
 
@@ -1299,99 +1917,92 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ 请输入有效的数字")
         return
 
-    elif custom_type == "xhs_count":
-        # 小红书自定义刷新次数
-        try:
-            count = int(user_input)
-            if count <= 0:
-                await update.message.reply_text("❌ 请输入大于0的数字")
-                return
-            if count > 500:
-                await update.message.reply_text("⚠️ 刷新次数过多可能导致问题，建议不超过500次\n\n是否继续？回复'确认'或输入其他数字")
-                return
-
-            # Execute command with custom count
-            args = ["--mode", "full", "--refresh-count", str(count), "--max-notes", "50", "--model", "flash-lite"]
-
-            await update.message.reply_text(
-                f"✅ 已选择：刷新 {count} 次\n\n🌸 **刷小红书推荐**\n\n⏳ 正在执行...",
-                parse_mode="Markdown"
-            )
-
-            # Create process and run
-            try:
-                process = await asyncio.create_subprocess_exec(
-                    sys.executable,
-                    str(PROJECT_ROOT / "workflows" / "ai_xiaohongshu_homepage.py"),
-                    *args,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    cwd=str(PROJECT_ROOT),
-                    env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
-                )
 
-                stdout, stderr = await process.communicate()
-                stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-                stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
-                raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
+# Extensions /read <name> matches across the project
+SEARCHABLE_EXTENSIONS = (
+    '.py', '.txt', '.md', '.json', '.csv', '.yaml', '.yml',
+    '.ini', '.cfg', '.toml', '.srt', '.vtt', '.ass',
+    '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv'
+)
+# Directories never searched by /read <name>
+SEARCH_PRUNE_DIRS = frozenset({'.git', 'node_modules', '__pycache__', 'venv', '.venv', 'browser_data'})
 
-                if process.returncode == 0:
-                    await update.message.reply_text("✅ 执行完成！")
 
-                    # Find and send generated files
-                    generated = find_generated_files(PROJECT_ROOT, "scrape_xiaohongshu")
-                    if generated:
-                        state.generated_files = generated
-                        file_list = "\n".join(
-                            f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                            for i, f in enumerate(generated)
-                        )
+def human_size(size: int) -> str:
+    """"12.3 KB" below 1 MB, otherwise "4.56 MB", using integer rounding (no float formatting)"""
+    if size < 1024 * 1024:
+        tenths = (size * 10 + 512) // 1024
+        return f"{tenths // 10}.{tenths % 10} KB"
+    hundredths = (size * 100 + 512 * 1024) // (1024 * 1024)
+    return f"{hundredths // 100}.{hundredths % 100:02d} MB"
 
-                        await update.message.reply_text(
-                            f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
-                            f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
-                        )
-                        state.phase = "file_select"
-                    else:
-                        # Check if output mentions "video already exists" or "skipped download"
-                        video_exists_msg = ""
-                        if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                            video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                        elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                            video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
 
-                        if video_exists_msg:
-                            await update.message.reply_text(
-                                f"✅ 执行完成！{video_exists_msg}"
-                            )
-                        else:
-                            await update.message.reply_text("✅ 执行完成！\n\n没有生成新的文件。")
-                        state.clear()
-                else:
-                    await update.message.reply_text(
-                        f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                        parse_mode="Markdown"
-                    )
-                    state.clear()
+def scan_project_files(project_root: Path) -> List[tuple]:
+    """List (name_lower, path, name, rel_path, size) for searchable project files (blocking)"""
+    root = str(project_root)
+    entries = []
+    stack = [root]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    name_lower = entry.name.lower()
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in SEARCH_PRUNE_DIRS:
+                                stack.append(entry.path)
+                            continue
+                        # Extension check comes first so only candidates are stat'ed
+                        if not name_lower.endswith(SEARCHABLE_EXTENSIONS) or not entry.is_file():
+                            continue
+                        size = entry.stat().st_size
+                    except OSError:
+                        continue
+                    entries.append((name_lower, entry.path, entry.name, os.path.relpath(entry.path, root), size))
+        except OSError:
+            # Missing or unreadable directory
+            continue
+    return entries
+
+
+class ProjectFileIndex:
+    """Searchable project files, rescanned at most once per TTL"""
+
+    def __init__(self, project_root: Path, ttl: float = 60):
+        self.project_root = project_root
+        self.ttl = ttl
+        self._entries: List[tuple] = []
+        self._built_at: Optional[float] = None
+        self._lock = asyncio.Lock()  # Concurrent searches share one rescan
+
+    async def search(self, search_term: str) -> List[Dict]:
+        """Return project files whose lowercase name contains search_term"""
+        async with self._lock:
+            if self._built_at is None or time.monotonic() - self._built_at > self.ttl:
+                self._entries = await asyncio.to_thread(scan_project_files, self.project_root)
+                self._built_at = time.monotonic()
+        return [
+            {
+                "path": path,
+                "name": name,
+                "rel_path": rel_path,
+                "size_str": human_size(size),
+                "size": size,
+                "is_project_file": True
+            }
+            for name_lower, path, name, rel_path, size in self._entries
+            if search_term in name_lower
+        ]
 
-            except Exception as e:
-                await update.message.reply_text(f"❌ 执行错误: {str(e)}")
-                state.clear()
 
-        except ValueError:
-            await update.message.reply_text("❌ 请输入有效的数字")
-        return
+PROJECT_FILE_INDEX = ProjectFileIndex(PROJECT_ROOT)
 
 
+@require_auth
 async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Read file content command"""
     user_id = update.effective_user.id
 
-    # Check user authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
     # Get user input from command args first (for /read command)
     user_input = " ".join(context.args) if context.args else ""
 
@@ -1419,10 +2030,7 @@ async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # Show file list
-        file_list = "\n".join(
-            f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-            for i, f in enumerate(state.generated_files)
-        )
+        file_list = format_file_list(state.generated_files)
 
         await update.message.reply_text(
             f"📂 **可读取的文件**\n\n{file_list}\n\n"
@@ -1458,21 +2066,25 @@ async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         try:
             # Send file as document instead of text
-            with open(file_path, "rb") as f:
-                file_type = file_info.get("type", "文件")
+            file_type = file_info.get("type", "文件")
 
-                # Build caption
-                if file_info.get("is_project_file"):
-                    rel_path = file_info.get("rel_path", file_info["name"])
-                    caption = f"{file_type}\n📁 路径: `{rel_path}`\n📦 大小: {file_info['size_str']}"
-                else:
-                    caption = f"{file_type}\n📦 大小: {file_info['size_str']}"
+            # Build caption
+            if file_info.get("is_project_file"):
+                rel_path = file_info.get("rel_path", file_info["name"])
+                caption = f"{file_type}\n📁 路径: `{rel_path}`\n📦 大小: {file_info['size_str']}"
+            else:
+                caption = f"{file_type}\n📦 大小: {file_info['size_str']}"
 
-                await update.message.reply_document(
-                    document=f,
-                    filename=file_info["name"],
-                    caption=caption
-                )
+            size = file_info.get("size")
+            if (size if size is not None else file_path.stat().st_size) > TELEGRAM_UPLOAD_LIMIT:
+                await update.message.reply_text(upload_too_large_text(file_info))
+                return
+
+            await update.message.reply_document(
+                document=file_path,
+                filename=file_info["name"],
+                caption=caption
+            )
 
         except FileNotFoundError:
             await update.message.reply_text(f"❌ 文件不存在: {file_info['name']}")
@@ -1492,44 +2104,14 @@ async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     generated_matches.append(f)
 
         # Then, search in entire project root directory
-        project_matches = []
-        searchable_extensions = {
-            '.py', '.txt', '.md', '.json', '.csv', '.yaml', '.yml',
-            '.ini', '.cfg', '.toml', '.srt', '.vtt', '.ass',
-            '.mp4', '.mkv', '.avi', '.mov', '.flv', '.wmv'
-        }
-
-        # Debug: Print search info
-        print(f"\n🔍 [SEARCH] Searching for: '{user_input}'")
-        print(f"🔍 [SEARCH] Search root: {PROJECT_ROOT}")
-
-        try:
-            for file_path in PROJECT_ROOT.rglob("*"):
-                if file_path.is_file():
-                    # Check if file extension is searchable (text file)
-                    if file_path.suffix.lower() in searchable_extensions:
-                        if search_term in file_path.name.lower():
-                            # Get relative path from project root
-                            rel_path = file_path.relative_to(PROJECT_ROOT)
-                            size = file_path.stat().st_size
-                            size_str = f"{size / 1024:.1f} KB" if size < 1024 * 1024 else f"{size / 1024 / 1024:.2f} MB"
-
-                            project_matches.append({
-                                "path": str(file_path),
-                                "name": file_path.name,
-                                "rel_path": str(rel_path),
-                                "size_str": size_str,
-                                "is_project_file": True
-                            })
-                            print(f"✅ [SEARCH] Found: {rel_path}")
-
-        except Exception as e:
-            print(f"⚠️ [SEARCH] Error: {e}")
-
-        print(f"🔍 [SEARCH] Total project matches: {len(project_matches)}")
+        logger.debug("🔍 Searching project for: %r", user_input)
+        project_matches = await PROJECT_FILE_INDEX.search(search_term)
+        logger.debug("🔍 Total project matches: %d", len(project_matches))
 
         # Combine matches, prioritize generated files first
-        all_matches = generated_matches + [m for m in project_matches if m not in generated_matches]
+        seen = {m['path'] for m in generated_matches}
+        project_matches = [m for m in project_matches if m['path'] not in seen]
+        all_matches = generated_matches + project_matches
 
         # Save search results for later reference
         state.search_results = all_matches
@@ -1550,17 +2132,21 @@ async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             try:
                 # Send file as document instead of text
-                with open(file_path, "rb") as f:
-                    file_type = file_info.get("type", "文件")
-                    rel_path = file_info.get("rel_path", file_info["name"])
+                file_type = file_info.get("type", "文件")
+                rel_path = file_info.get("rel_path", file_info["name"])
 
-                    caption = f"{file_type}\n📁 路径: `{rel_path}`\n📦 大小: {file_info['size_str']}"
+                caption = f"{file_type}\n📁 路径: `{rel_path}`\n📦 大小: {file_info['size_str']}"
 
-                    await update.message.reply_document(
-                        document=f,
-                        filename=file_info["name"],
-                        caption=caption
-                    )
+                size = file_info.get("size")
+                if (size if size is not None else file_path.stat().st_size) > TELEGRAM_UPLOAD_LIMIT:
+                    await update.message.reply_text(upload_too_large_text(file_info))
+                    return
+
+                await update.message.reply_document(
+                    document=file_path,
+                    filename=file_info["name"],
+                    caption=caption
+                )
 
             except FileNotFoundError:
                 await update.message.reply_text(f"❌ 文件不存在: {file_info['name']}")
@@ -1598,15 +2184,24 @@ async def cmd_read_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
 
+# Fixed tail of the /history file list
+HISTORY_USAGE = (
+    "\n\n"
+    "**使用方法**\n"
+    "• `/read 文件编号` - 读取并并发送第N个文件\n"
+    "• `/read 文件名` - 按名称查找文件\n"
+    "• `/read AI分析报告` - 读取最近AI报告\n"
+    "• `/read 继续` - 继续读取下一个文件\n"
+    "• `/read 全部` - 发送所有文件\n"
+    "• `/history` - 查看对话历史\n"
+)
+
+
+@require_auth
 async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all generated files"""
     user_id = update.effective_user.id
 
-    # Check user authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
     # Get user state
     state = get_user_state(user_id)
 
@@ -1620,35 +2215,19 @@ async def cmd_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Show all files
-    file_list = "\n".join(
-        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-        for i, f in enumerate(state.generated_files)
-    )
+    file_list = format_file_list(state.generated_files)
 
-    await update.message.reply_text(
-        f"📋 **生成的文件列表**\n\n{file_list}\n\n"
-        f"**使用方法**\n"
-        f"• `/read 文件编号` - 读取并并发送第N个文件\n"
-        f"• `/read 文件名` - 按名称查找文件\n"
-        f"• `/read AI分析报告` - 读取最近AI报告\n"
-        f"• `/read 继续` - 继续读取下一个文件\n"
-        f"• `/read 全部` - 发送所有文件\n"
-        f"• `/history` - 查看对话历史\n"
-        )
+    await update.message.reply_text("".join(("📋 **生成的文件列表**\n\n", file_list, HISTORY_USAGE)))
 
     # Update help text to include /history command
     state.clear()
 
 
+@require_auth
 async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Process conversational /ask command"""
     user_id = update.effective_user.id
 
-    # Check user authorization
-    if ALLOWED_USERS and user_id not in ALLOWED_USERS:
-        await update.message.reply_text("❌ 未授权用户")
-        return
-
     # Get user input
     user_input = " ".join(context.args) if context.args else ""
     if not user_input:
@@ -1696,10 +2275,10 @@ async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Add user input to history
     state.history.append(user_input)
 
-    await update.message.reply_text(f"🧠 理解中：`{user_input}`", parse_mode="Markdown")
+    await update.message.reply_text(f"🧠 理解中：<code>{html.escape(user_input)}</code>", parse_mode="HTML")
 
     # Call Gemini
-    result = await chat_with_gemini(user_input, state.history)
+    result = await chat_with_gemini(user_input, list(state.history))
 
     if result.get("mode") == "error":
         await update.message.reply_text(f"❌ {result.get('response', '未知错误')}")
@@ -1728,12 +2307,7 @@ async def cmd_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state.phase = "confirm"
 
         # Build confirmation message with inline keyboard
-        keyboard = InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("✅ 确认执行", callback_data=f"confirm_{command}"),
-                InlineKeyboardButton("❌ 取消", callback_data=f"cancel_{command}")
-            ]
-        ])
+        keyboard = CONFIRM_KEYBOARDS[command]
 
         await update.message.reply_text(
             f"✅ 我理解你想：\n\n{summary}\n\n确认执行吗？",
@@ -1762,8 +2336,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     data = query.data
     state = get_user_state(user_id)
+    # callback_data is "<action>_<argument>", parsed once for every branch
+    action, _, arg = data.partition("_")
 
-    if data.startswith("cancel_"):
+    if action == "cancel":
         # User cancelled
         await query.edit_message_text("❌ 已取消执行")
         state.clear()
@@ -1857,11 +2433,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Subtitle model selection
-    if data.startswith("subtitle_"):
-        # Parse: subtitle_<model>_<url (optional)>
-        parts = data.split("_", 2)
-        model = parts[1] if len(parts) > 1 else "flash-lite"
-        url = parts[2] if len(parts) > 2 else ""
+    if action == "subtitle":
+        # Parse: subtitle_<model>_<url token (optional)>
+        model, _, token = arg.partition("_")
+        url = state.url_tokens.get(token, "")
 
         # Build command args based on mode
         if model == "only":
@@ -1906,38 +2481,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
-            stdout, stderr = await process.communicate()
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            # Save process reference
+            set_user_process(user_id, process)
+
+            stdout_text, stderr_text = await read_process_output(process)
+            clear_user_process(user_id)
             raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
 
             if process.returncode == 0:
-                await query.message.reply_text("✅ 执行完成！")
-
                 # Find and send generated files
-                generated = find_generated_files(PROJECT_ROOT, "subtitle")
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, "subtitle")
                 if generated:
-                    state.generated_files = generated
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    state.offer_files(generated)
+                    file_list = format_file_list(generated)
 
                     await query.message.reply_text(
                         f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
                         f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
                     )
-                    state.phase = "file_select"
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
                         await query.message.reply_text(
@@ -1948,23 +2516,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     state.clear()
             else:
                 await query.message.reply_text(
-                    f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                    parse_mode="Markdown"
+                    f"⚠️ 执行完成，但有警告\n\n{output_tail_html(raw_output)}",
+                    parse_mode="HTML"
                 )
                 state.clear()
 
         except Exception as e:
+            clear_user_process(user_id)
             await query.message.reply_text(f"❌ 执行错误: {str(e)}")
             state.clear()
 
         return
 
     # Notes mode selection
-    if data.startswith("notes_"):
-        # Parse: notes_<mode>_<url (optional)>
-        parts = data.split("_", 2)
-        mode = parts[1] if len(parts) > 1 else "default"
-        url = parts[2] if len(parts) > 2 else ""
+    if action == "notes":
+        # Parse: notes_<mode>_<url token (optional)>
+        mode, _, token = arg.partition("_")
+        url = state.url_tokens.get(token, "")
 
         # Build command args based on mode
         if mode == "default":
@@ -2015,38 +2583,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
-            stdout, stderr = await process.communicate()
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            # Save process reference
+            set_user_process(user_id, process)
+
+            stdout_text, stderr_text = await read_process_output(process)
+            clear_user_process(user_id)
             raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
 
             if process.returncode == 0:
-                await query.message.reply_text("✅ 执行完成！")
-
                 # Find and send generated files
-                generated = find_generated_files(PROJECT_ROOT, "notes")
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, "notes")
                 if generated:
-                    state.generated_files = generated
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    state.offer_files(generated)
+                    file_list = format_file_list(generated)
 
                     await query.message.reply_text(
                         f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
                         f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
                     )
-                    state.phase = "file_select"
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
                         await query.message.reply_text(
@@ -2057,21 +2618,44 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     state.clear()
             else:
                 await query.message.reply_text(
-                    f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                    parse_mode="Markdown"
+                    f"⚠️ 执行完成，但有警告\n\n{output_tail_html(raw_output)}",
+                    parse_mode="HTML"
                 )
                 state.clear()
 
         except Exception as e:
+            clear_user_process(user_id)
             await query.message.reply_text(f"❌ 执行错误: {str(e)}")
             state.clear()
 
         return
 
     # B站刷屏
-    if data.startswith("bili_"):
+    # B站自定义次数
+    if data == "bili_custom":
+        await query.edit_message_text(
+            "✏️ **自定义刷新次数**\n\n请输入你想要的刷新次数（例如：25、80、150）：\n\n💡 直接回复数字即可，不需要输入'次'",
+            parse_mode="Markdown"
+        )
+        # Set state to expect custom input
+        state.phase = "custom_input"
+        state.custom_input_type = "bili_count"
+        return
+
+    # 小红书自定义次数
+    if data == "xhs_custom":
+        await query.edit_message_text(
+            "✏️ **自定义刷新次数**\n\n请输入你想要的刷新次数（例如：25、80、150）：\n\n💡 直接回复数字即可，不需要输入'次'",
+            parse_mode="Markdown"
+        )
+        # Set state to expect custom input
+        state.phase = "custom_input"
+        state.custom_input_type = "xhs_count"
+        return
+
+    if action == "bili":
         # Parse: bili_<count>
-        count = int(data.split("_")[1])
+        count = int(arg)
         args = ["--mode", "full", "--refresh-count", str(count), "--max-videos", "50", "--model", "flash-lite"]
 
         await query.edit_message_text(
@@ -2088,38 +2672,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
-            stdout, stderr = await process.communicate()
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            # Save process reference
+            set_user_process(user_id, process)
+
+            stdout_text, stderr_text = await read_process_output(process)
+            clear_user_process(user_id)
             raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
 
             if process.returncode == 0:
-                await query.message.reply_text("✅ 执行完成！")
-
                 # Find and send generated files
-                generated = find_generated_files(PROJECT_ROOT, "scrape_bilibili")
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, "scrape_bilibili")
                 if generated:
-                    state.generated_files = generated
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    state.offer_files(generated)
+                    file_list = format_file_list(generated)
 
                     await query.message.reply_text(
                         f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
                         f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
                     )
-                    state.phase = "file_select"
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
                         await query.message.reply_text(
@@ -2130,21 +2707,22 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     state.clear()
             else:
                 await query.message.reply_text(
-                    f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                    parse_mode="Markdown"
+                    f"⚠️ 执行完成，但有警告\n\n{output_tail_html(raw_output)}",
+                    parse_mode="HTML"
                 )
                 state.clear()
 
         except Exception as e:
+            clear_user_process(user_id)
             await query.message.reply_text(f"❌ 执行错误: {str(e)}")
             state.clear()
 
         return
 
     # 小红书刷屏
-    if data.startswith("xhs_"):
+    if action == "xhs":
         # Parse: xhs_<count>
-        count = int(data.split("_")[1])
+        count = int(arg)
         args = ["--mode", "full", "--refresh-count", str(count), "--max-notes", "50", "--model", "flash-lite"]
 
         await query.edit_message_text(
@@ -2161,38 +2739,31 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
-            stdout, stderr = await process.communicate()
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            # Save process reference
+            set_user_process(user_id, process)
+
+            stdout_text, stderr_text = await read_process_output(process)
+            clear_user_process(user_id)
             raw_output = stdout_text + ('\n' + stderr_text if stderr_text else '')
 
             if process.returncode == 0:
-                await query.message.reply_text("✅ 执行完成！")
-
                 # Find and send generated files
-                generated = find_generated_files(PROJECT_ROOT, "scrape_xiaohongshu")
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, "scrape_xiaohongshu")
                 if generated:
-                    state.generated_files = generated
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    state.offer_files(generated)
+                    file_list = format_file_list(generated)
 
                     await query.message.reply_text(
                         f"✅ 执行完成！\n\n我生成了以下文件：\n\n{file_list}\n\n"
                         f"你想要哪些？可以：\n• 全部发送\n• 只要特定类型\n• 指定文件编号\n\n用自然语言回复即可"
                     )
-                    state.phase = "file_select"
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
                         await query.message.reply_text(
@@ -2203,44 +2774,23 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     state.clear()
             else:
                 await query.message.reply_text(
-                    f"⚠️ 执行完成，但有警告\n\n```\n{raw_output[-1000:]}\n```",
-                    parse_mode="Markdown"
+                    f"⚠️ 执行完成，但有警告\n\n{output_tail_html(raw_output)}",
+                    parse_mode="HTML"
                 )
                 state.clear()
 
         except Exception as e:
+            clear_user_process(user_id)
             await query.message.reply_text(f"❌ 执行错误: {str(e)}")
             state.clear()
 
         return
 
-    # B站自定义次数
-    if data == "bili_custom":
-        await query.edit_message_text(
-            "✏️ **自定义刷新次数**\n\n请输入你想要的刷新次数（例如：25、80、150）：\n\n💡 直接回复数字即可，不需要输入'次'",
-            parse_mode="Markdown"
-        )
-        # Set state to expect custom input
-        state.phase = "custom_input"
-        state.custom_input_type = "bili_count"
-        return
-
-    # 小红书自定义次数
-    if data == "xhs_custom":
-        await query.edit_message_text(
-            "✏️ **自定义刷新次数**\n\n请输入你想要的刷新次数（例如：25、80、150）：\n\n💡 直接回复数字即可，不需要输入'次'",
-            parse_mode="Markdown"
-        )
-        # Set state to expect custom input
-        state.phase = "custom_input"
-        state.custom_input_type = "xhs_count"
-        return
-
     # ==================== End Quick Button Callbacks ====================
 
-    if data.startswith("retry_"):
+    if action == "retry":
         # User requested retry
-        delay = int(data.split("_", 1)[1])
+        delay = int(arg)
 
         await query.edit_message_text(f"⏳ {delay}秒后自动重试...")
         await asyncio.sleep(delay)
@@ -2261,45 +2811,35 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         url = pending.get("url", "")
 
         config = COMMAND_MAP[cmd]
-        script = PROJECT_ROOT / config["script"]
-        base_args = config["base_args"]
-        url_arg_pos = config.get("url_arg_pos")
 
         # Build final args
-        final_args = base_args.copy()
-        if url and url_arg_pos is not None:
-            final_args.insert(url_arg_pos, url)
+        final_args = list(config.base_args)
+        if url and config.url_arg_pos is not None:
+            final_args.insert(config.url_arg_pos, url)
         final_args.extend(args)
 
         await query.message.reply_text(
             f"🔄 正在重试 ({state.retry_count}/{state.max_retries})：`/{cmd}`\n"
-            f"📥 命令：`python {config['script']} {' '.join(final_args)}`",
+            f"📥 命令：`python {config.script} {' '.join(final_args)}`\n\n"
+            f"⏳ 正在执行...",
             parse_mode="Markdown"
         )
 
         # Execute the same command again
-        await query.message.reply_text("⏳ 正在执行...")
-
         try:
             # Check if user already has a process running
-            existing_process = get_user_process(user_id)
-            if existing_process:
-                try:
-                    if hasattr(existing_process, 'kill'):
-                        existing_process.kill()
-                    await asyncio.sleep(0.5)
-                except Exception:
-                    pass
+            await kill_user_process(user_id)
 
             # Create and start process
             process = await asyncio.create_subprocess_exec(
                 sys.executable,
-                str(script),
+                config.script_path,
                 *final_args,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
             # Save process reference
@@ -2307,20 +2847,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             state.process = process
 
             # Read output and wait for process to complete
-            stdout, stderr = await process.communicate()
-
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            stdout_text, stderr_text = await read_process_output(process)
 
             # Filter out Playwright/HTML warnings
-            import re
-            warning_pattern = r'^\d+\s+elements\. Proceeding with the first one:'
-            filtered_stderr = '\n'.join(
-                line for line in stderr_text.split('\n')
-                if not re.search(warning_pattern, line)
-                and 'data-v-' not in line
-                and '<div' not in line
-            )
+            filtered_stderr = _filter_stderr(stderr_text)
 
             raw_output = stdout_text + ('\n' + filtered_stderr if filtered_stderr else '')
 
@@ -2335,32 +2865,29 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await query.message.reply_text("✅ 重试成功！")
 
                 # Find generated files and show them
-                generated = find_generated_files(PROJECT_ROOT, cmd)
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, cmd)
 
                 ai_summary = None
                 if generated:
                     for f in generated:
                         if f.get('is_ai_summary'):
-                            ai_summary = read_ai_summary(Path(f['path']))
+                            ai_summary = await read_ai_summary(Path(f['path']))
                             generated = [g for g in generated if not g.get('is_ai_summary')]
                             break
 
+                replies = []
                 if ai_summary:
-                    await query.message.reply_text(
+                    replies.append(query.message.reply_text(
                         f"📊 **AI分析报告**\n\n{ai_summary}",
                         parse_mode="Markdown"
-                    )
+                    ))
 
                 if generated:
-                    state.generated_files = generated
-                    state.phase = "file_select"
+                    state.offer_files(generated)
 
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    file_list = format_file_list(generated)
 
-                    await query.message.reply_text(
+                    replies.append(query.message.reply_text(
                         f"✅ 执行完成！\n\n"
                         f"我生成了以下文件：\n\n{file_list}\n\n"
                         f"你想要哪些？可以：\n"
@@ -2368,24 +2895,22 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                         f"• 只要特定类型（如'只要文档'）\n"
                         f"• 指定文件编号\n\n"
                         f"用自然语言回复即可"
-                    )
+                    ))
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！{video_exists_msg}"
-                        )
+                        ))
                     else:
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！\n\n没有生成新的文件。"
-                        )
+                        ))
                     state.clear()
+
+                await _reply_all(replies)
             else:
                 # Retry failed again - show retry options
                 error_str = raw_output if raw_output else "No output"
@@ -2394,7 +2919,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 error_msg = ""
                 if raw_output:
-                    error_msg = f"⚠️ 重试未完成。\n\n```\n{raw_output[-1000:]}\n```"
+                    error_msg = f"⚠️ 重试未完成。\n\n{output_tail_html(raw_output)}"
                 else:
                     error_msg = "⚠️ 重试未完成，没有输出信息。"
 
@@ -2412,18 +2937,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                     await query.message.reply_text(
                         f"{error_msg}\n\n"
-                        f"📊 错误类型: `{error_type}`\n\n"
+                        f"📊 错误类型: <code>{error_type}</code>\n\n"
                         f"💡 检测到网络问题，建议自动重试。\n\n"
                         f"点击下方按钮选择操作：",
-                        reply_markup=keyboard
+                        reply_markup=keyboard,
+                        parse_mode="HTML"
                     )
                 else:
                     # Max retries reached or not retryable
                     await query.message.reply_text(
                         f"{error_msg}\n\n"
-                        f"📊 错误类型: `{error_type}`\n\n"
+                        f"📊 错误类型: <code>{error_type}</code>\n\n"
                         f"❌ 已达到最大重试次数或错误不支持重试。\n\n"
-                        f"💡 如需继续执行，请发送 `/ask 继续`"
+                        f"💡 如需继续执行，请发送 <code>/ask 继续</code>",
+                        parse_mode="HTML"
                     )
                     state.clear()
 
@@ -2439,9 +2966,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         return
 
-    if data.startswith("confirm_"):
+    if action == "confirm":
         # User confirmed execution
-        command = data.split("_", 1)[1]
+        command = arg
         pending = state.pending_command
 
         if not pending or pending.get("command") != command:
@@ -2455,47 +2982,36 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         url = pending.get("url", "")
 
         config = COMMAND_MAP[cmd]
-        script = PROJECT_ROOT / config["script"]
-        base_args = config["base_args"]
-        url_arg_pos = config.get("url_arg_pos")
 
         # Build final args
-        final_args = base_args.copy()
-        if url and url_arg_pos is not None:
-            final_args.insert(url_arg_pos, url)
+        final_args = list(config.base_args)
+        if url and config.url_arg_pos is not None:
+            final_args.insert(config.url_arg_pos, url)
         final_args.extend(args)
 
         await query.edit_message_text(
             f"✅ 确认执行：`/{cmd}`\n"
-            f"📥 命令：`python {config['script']} {' '.join(final_args)}`",
+            f"📥 命令：`python {config.script} {' '.join(final_args)}`",
             parse_mode="Markdown"
         )
 
         # Execute
-        await query.message.reply_text("⏳ 正在执行...")
-        await query.message.reply_text("💡 如需停止，请发送 /stop")
+        await query.message.reply_text("⏳ 正在执行...\n💡 如需停止，请发送 /stop")
 
         try:
             # Check if user already has a process running
-            existing_process = get_user_process(user_id)
-            if existing_process:
-                # Try to kill existing process
-                try:
-                    if hasattr(existing_process, 'kill'):
-                        existing_process.kill()
-                    await asyncio.sleep(0.5)
-                except Exception:
-                    pass
+            await kill_user_process(user_id)
 
             # Create and start process
             process = await asyncio.create_subprocess_exec(
                 sys.executable,
-                str(script),
+                config.script_path,
                 *final_args,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
                 cwd=str(PROJECT_ROOT),
-                env={**os.environ, 'PYTHONUNBUFFERED': '1', 'PYTHONIOENCODING': 'utf-8'}
+                env=SUBPROCESS_ENV,
+                start_new_session=True
             )
 
             # Save process reference so it can be stopped
@@ -2503,22 +3019,10 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             state.process = process
 
             # Read output and wait for process to complete
-            # communicate() waits for the process and returns (stdout, stderr)
-            stdout, stderr = await process.communicate()
-
-            stdout_text = (stdout.decode('utf-8', errors='replace') if stdout else '')
-            stderr_text = (stderr.decode('utf-8', errors='replace') if stderr else '')
+            stdout_text, stderr_text = await read_process_output(process)
 
             # Filter out Playwright/HTML warnings
-            # Remove lines like: "21 elements. Proceeding with the first one: <div..."
-            import re
-            warning_pattern = r'^\d+\s+elements\. Proceeding with the first one:'
-            filtered_stderr = '\n'.join(
-                line for line in stderr_text.split('\n')
-                if not re.search(warning_pattern, line)
-                and 'data-v-' not in line  # Also filter HTML with data-v- attributes
-                and '<div' not in line  # Filter HTML tags
-            )
+            filtered_stderr = _filter_stderr(stderr_text)
 
             raw_output = stdout_text + ('\n' + filtered_stderr if filtered_stderr else '')
 
@@ -2528,37 +3032,34 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
             if process.returncode == 0:
                 # Find generated files
-                generated = find_generated_files(PROJECT_ROOT, cmd)
+                generated = await asyncio.to_thread(find_generated_files, PROJECT_ROOT, cmd)
 
                 # Check if there's an AI summary (for scrape commands)
                 ai_summary = None
                 if generated:
                     for f in generated:
                         if f.get('is_ai_summary'):
-                            ai_summary = read_ai_summary(Path(f['path']))
+                            ai_summary = await read_ai_summary(Path(f['path']))
                             # Remove AI summary from the list so it's not included in file selection
                             generated = [g for g in generated if not g.get('is_ai_summary')]
                             break
 
+                # The summary goes out before the file-list prompt that follows it
+                replies = []
                 if ai_summary:
-                    # Send AI summary first
-                    await query.message.reply_text(
+                    replies.append(query.message.reply_text(
                         f"📊 **AI分析报告**\n\n{ai_summary}",
                         parse_mode="Markdown"
-                    )
+                    ))
 
                 if generated:
-                    state.generated_files = generated
-                    state.phase = "file_select"
+                    state.offer_files(generated)
 
-                    file_list = "\n".join(
-                        f"{i+1}. {f['name']} ({f['type']}, {f['size_str']})"
-                        for i, f in enumerate(generated)
-                    )
+                    file_list = format_file_list(generated)
 
                     if ai_summary:
                         # If AI summary was shown, just ask about other files
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！\n\n"
                             f"其他生成的文件：\n\n{file_list}\n\n"
                             f"你想要哪些？可以：\n"
@@ -2566,9 +3067,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             f"• 只要特定类型（如'只要文档'）\n"
                             f"• 指定文件编号\n\n"
                             f"用自然语言回复即可"
-                        )
+                        ))
                     else:
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！\n\n"
                             f"我生成了以下文件：\n\n{file_list}\n\n"
                             f"你想要哪些？可以：\n"
@@ -2576,24 +3077,22 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             f"• 只要特定类型（如'只要文档'）\n"
                             f"• 指定文件编号\n\n"
                             f"用自然语言回复即可"
-                        )
+                        ))
                 else:
                     # Check if output mentions "video already exists" or "skipped download"
-                    video_exists_msg = ""
-                    if "视频已存在" in raw_output or "跳过下载" in raw_output:
-                        video_exists_msg = "\n📹 视频已下载，跳过重复下载。"
-                    elif "笔记已存在" in raw_output or "skip" in raw_output.lower():
-                        video_exists_msg = "\n📝 内容已存在，跳过重复处理。"
+                    video_exists_msg = skipped_work_note(raw_output)
 
                     if video_exists_msg:
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！{video_exists_msg}"
-                        )
+                        ))
                     else:
-                        await query.message.reply_text(
+                        replies.append(query.message.reply_text(
                             f"✅ 执行完成！\n\n没有生成新的文件。"
-                        )
+                        ))
                     state.clear()
+
+                await _reply_all(replies)
             else:
                 # Command failed - ask user if they want to continue
                 # Don't show file selection, don't clear state
@@ -2601,14 +3100,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 error_msg = ""
                 if raw_output:
-                    error_msg = f"⚠️ 执行未完成。\n\n```\n{raw_output[-1000:]}\n```"
+                    error_msg = f"⚠️ 执行未完成。\n\n{output_tail_html(raw_output)}"
                 else:
                     error_msg = "⚠️ 执行未完成，没有输出信息。"
 
                 await query.message.reply_text(
                     f"{error_msg}\n\n"
-                    f"💡 如需继续执行，请发送 `/ask 继续`\n"
-                    f"我会询问你是否要重新执行命令。"
+                    f"💡 如需继续执行，请发送 <code>/ask 继续</code>\n"
+                    f"我会询问你是否要重新执行命令。",
+                    parse_mode="HTML"
                 )
 
                 # Don't clear state - keep it so user can continue with /ask
@@ -2621,7 +3121,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 
                 error_msg = ""
                 if raw_output:
-                    error_msg = f"⚠️ 执行未完成。\n\n```\n{raw_output[-1000:]}\n```"
+                    error_msg = f"⚠️ 执行未完成。\n\n{output_tail_html(raw_output)}"
                 else:
                     error_msg = "⚠️ 执行未完成，没有输出信息。"
                 
@@ -2640,18 +3140,20 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     
                     await query.message.reply_text(
                         f"{error_msg}\n\n"
-                        f"📊 错误类型: `{error_type}`\n\n"
+                        f"📊 错误类型: <code>{error_type}</code>\n\n"
                         f"💡 检测到网络问题，建议自动重试。\n\n"
                         f"点击下方按钮选择操作：",
-                        reply_markup=keyboard
+                        reply_markup=keyboard,
+                        parse_mode="HTML"
                     )
                 else:
                     # Not retryable or max retries reached
                     await query.message.reply_text(
                         f"{error_msg}\n\n"
-                        f"📊 错误类型: `{error_type}`\n\n"
-                        f"💡 如需继续执行，请发送 `/ask 继续`\n"
-                        f"我会询问你是否要重新执行命令。"
+                        f"📊 错误类型: <code>{error_type}</code>\n\n"
+                        f"💡 如需继续执行，请发送 <code>/ask 继续</code>\n"
+                        f"我会询问你是否要重新执行命令。",
+                        parse_mode="HTML"
                     )
                     state.clear()
                 
@@ -2670,13 +3172,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             # Don't clear state - let user decide with /ask
             # state.clear()  # REMOVED
         except Exception as e:
-            error_msg = f"❌ 执行错误: {str(e)}"
+            msg = str(e)
+            error_msg = f"❌ 执行错误: {msg}"
             # Handle query expired errors gracefully
-            if "Query is too old" in str(e) or "response timeout" in str(e):
+            lower = msg.casefold()
+            if "query is too old" in lower or "response timeout" in lower:
                 # Query expired, try to send new message instead
                 try:
                     await query.message.reply_text(
-                        f"⚠️ 确认按钮已过期，请重新执行命令。\n\n错误详情: {str(e)}"
+                        f"⚠️ 确认按钮已过期，请重新执行命令。\n\n错误详情: {msg}"
                     )
                 except Exception:
                     # If that also fails, just log
@@ -2699,6 +3203,34 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ==================== Main ====================
 
+# Slash commands and their handlers
+COMMAND_HANDLERS = (
+    ("start", cmd_start),
+    ("ask", cmd_ask),
+    ("read", cmd_read_file),
+    ("history", cmd_history),
+    ("stop", cmd_stop),
+    ("help", cmd_start),
+    # Quick button commands
+    ("subtitle", cmd_btn_subtitle),
+    ("notes", cmd_btn_notes),
+    ("bili", cmd_btn_bili),
+    ("xhs", cmd_btn_xhs),
+)
+
+
+# Worker threads for file scans and aiofiles reads
+BLOCKING_IO_WORKERS = 8
+
+
+async def on_startup(application: Application):
+    """Bound the default executor and start background housekeeping"""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="help-bot-io")
+    )
+    application.create_task(sweep_user_states())
+
+
 def main():
     print("\n" + "="*80)
     print("🚀 智能内容处理 Bot 启动中...")
@@ -2708,7 +3240,7 @@ def main():
     print(f"✅ Gemini API Key: {GEMINI_API_KEY[:20]}...{GEMINI_API_KEY[-10:]}")
 
     if ALLOWED_USERS:
-        print(f"🔒 仅限用户: {ALLOWED_USERS}")
+        print(f"🔒 仅限用户: {sorted(ALLOWED_USERS)}")
     else:
         print("🔓 开放模式：所有用户都可以使用")
 
@@ -2717,14 +3249,24 @@ def main():
     print("  • 执行前确认 - 避免误操作")
     print("  • 文件选择 - 选择需要的输出")
 
+    # Use uvloop when installed; run_polling creates its loop from the policy
+    if HAS_UVLOOP:
+        uvloop.install()
+        print("⚡ 事件循环: uvloop")
+
     # Create application
-    builder = Application.builder().token(BOT_TOKEN)
+    builder = Application.builder().token(BOT_TOKEN).post_init(on_startup)
+    if HAS_RATE_LIMITER:
+        # PTB defaults: 30 msg/s overall and 20 msg/min per group chat. There is
+        # no per-private-chat limit; 429s beyond these are retried up to 3 times
+        builder = builder.rate_limiter(AIORateLimiter(max_retries=3))
+        print("🚦 发送限速: AIORateLimiter")
     application = builder.build()
 
     # Add global error handler
     async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
         """Handle all errors globally"""
-        print(f"\n❌ [ERROR] {type(context.error).__name__}: {context.error}")
+        logger.error("❌ [ERROR] %s: %s", type(context.error).__name__, context.error, exc_info=context.error)
 
         # Don't respond to polls or callback queries that are too old
         if update and hasattr(update, 'effective_message'):
@@ -2733,23 +3275,26 @@ def main():
                     f"❌ 发生错误: {type(context.error).__name__}\n\n{context.error}",
                     timeout=10
                 )
-            except Exception as e:
-                print(f"❌ Failed to send error message: {e}")
+            except Exception:
+                logger.exception("❌ Failed to send error message")
 
     application.add_error_handler(error_handler)
 
+    # Shared state store: load before (group -1) and save after (group 1)
+    # the regular handlers in group 0
+    global STATE_STORE
+    if STATE_BACKEND == 'redis':
+        if HAS_REDIS:
+            STATE_STORE = StateStore(REDIS_URL)
+            application.add_handler(TypeHandler(Update, load_state_hook), group=-1)
+            application.add_handler(TypeHandler(Update, save_state_hook), group=1)
+            print(f"🗄️ 会话状态存储: Redis ({REDIS_URL})")
+        else:
+            print("⚠️ 未安装 redis，会话状态仅保存在内存中")
+
     # Register commands
-    application.add_handler(CommandHandler("start", cmd_start))
-    application.add_handler(CommandHandler("ask", cmd_ask))
-    application.add_handler(CommandHandler("read", cmd_read_file))
-    application.add_handler(CommandHandler("history", cmd_history))
-    application.add_handler(CommandHandler("stop", cmd_stop))
-    application.add_handler(CommandHandler("help", cmd_start))
-    # Quick button commands
-    application.add_handler(CommandHandler("subtitle", cmd_btn_subtitle))
-    application.add_handler(CommandHandler("notes", cmd_btn_notes))
-    application.add_handler(CommandHandler("bili", cmd_btn_bili))
-    application.add_handler(CommandHandler("xhs", cmd_btn_xhs))
+    for name, callback in COMMAND_HANDLERS:
+        application.add_handler(CommandHandler(name, callback))
     application.add_handler(CallbackQueryHandler(button_callback))
     # Message handler for custom input
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_custom_input))
@@ -2760,6 +3305,9 @@ def main():
     print("="*80)
     print("\n💡 发送 /start 查看帮助\n")
 
+    # Index output directories so finished commands don't rewalk them
+    start_generated_file_index(PROJECT_ROOT)
+
     try:
         application.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
     except Exception as e:
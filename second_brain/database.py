@@ -7,10 +7,25 @@ import sqlite3
 import json
 from pathlib import Path
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 from typing import List, Dict, Optional, Any
 from contextlib import contextmanager
 
 
+def to_timestamp(published_at: Optional[str]) -> Optional[int]:
+    """把发布时间（ISO 或 RSS 的 RFC 822 格式）转换为 UNIX 时间戳，无法解析时返回 None"""
+    if not published_at:
+        return None
+    try:
+        return int(datetime.fromisoformat(published_at).timestamp())
+    except (TypeError, ValueError):
+        pass
+    try:
+        return int(parsedate_to_datetime(published_at).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
 class Database:
     """数据库管理类"""
 
@@ -19,18 +34,30 @@ class Database:
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
         self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
         self.conn.row_factory = sqlite3.Row
+        self._tx_depth = 0
         self._init_tables()
 
     @contextmanager
     def transaction(self):
-        """事务上下文管理器"""
+        """
+        事务上下文管理器
+
+        支持嵌套：只有最外层事务退出时才提交/回滚，
+        因此可以把多次 add_creator 等写操作合并为一次提交。
+        """
         cursor = self.conn.cursor()
+        self._tx_depth += 1
         try:
             yield cursor
-            self.conn.commit()
         except Exception:
-            self.conn.rollback()
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.rollback()
             raise
+        else:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self.conn.commit()
 
     def _init_tables(self):
         """初始化数据表"""
@@ -63,6 +90,7 @@ class Database:
                     description TEXT,
                     duration INTEGER,
                     published_at TIMESTAMP,
+                    published_ts INTEGER,
                     thumbnail_url TEXT,
                     video_url TEXT,
                     view_count INTEGER DEFAULT 0,
@@ -124,6 +152,19 @@ class Database:
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_analysis_status ON analysis_status(status)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_news_date ON news(news_date DESC)")
 
+            self._migrate_published_ts(cursor)
+
+    def _migrate_published_ts(self, cursor):
+        """旧库迁移：添加 published_ts 列并回填"""
+        cursor.execute("PRAGMA table_info(videos)")
+        if any(row['name'] == 'published_ts' for row in cursor.fetchall()):
+            return
+
+        cursor.execute("ALTER TABLE videos ADD COLUMN published_ts INTEGER")
+        cursor.execute("SELECT id, published_at FROM videos WHERE published_at IS NOT NULL")
+        rows = [(to_timestamp(row['published_at']), row['id']) for row in cursor.fetchall()]
+        cursor.executemany("UPDATE videos SET published_ts = ? WHERE id = ?", rows)
+
     # ==================== 博主相关 ====================
 
     def add_creator(self, platform: str, uid: str, name: str, category: str = "",
@@ -170,10 +211,11 @@ class Database:
             cursor.execute("""
                 INSERT OR IGNORE INTO videos
                 (creator_id, platform, video_id, title, description, duration, published_at,
-                 thumbnail_url, video_url, view_count, danmaku_count)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 published_ts, thumbnail_url, video_url, view_count, danmaku_count)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (creator_id, platform, video_id, title, description, duration,
-                  published_at, thumbnail_url, video_url, view_count, danmaku_count))
+                  published_at, to_timestamp(published_at), thumbnail_url, video_url,
+                  view_count, danmaku_count))
             return cursor.lastrowid
 
     def get_video(self, video_id: str, platform: str) -> Optional[Dict]:
@@ -222,6 +264,18 @@ class Database:
         """, (limit,))
         return [dict(row) for row in cursor.fetchall()]
 
+    def get_videos_by_ids(self, ids: List[int]) -> List[Dict]:
+        """按数据库ID获取视频"""
+        if not ids:
+            return []
+        cursor = self.conn.cursor()
+        placeholders = ",".join("?" * len(ids))
+        cursor.execute(f"""
+            SELECT * FROM videos WHERE id IN ({placeholders})
+            ORDER BY published_at DESC
+        """, list(ids))
+        return [dict(row) for row in cursor.fetchall()]
+
     # ==================== 分析状态相关 ====================
 
     def create_analysis_status(self, video_id: int, status: str = "pending") -> int:
@@ -42,6 +42,8 @@ try:
 except ImportError:
     HAS_BS4 = False
 
+from second_brain.database import to_timestamp
+
 
 # ==================== 平台API ====================
 
@@ -582,7 +584,8 @@ class VideoMonitor:
 
                 new_videos.append({
                     **video,
-                    "db_id": video_id_in_db
+                    "db_id": video_id_in_db,
+                    "published_ts": to_timestamp(video.get("published_at")),
                 })
 
         # 记录日志
@@ -662,6 +665,7 @@ class VideoMonitor:
         stats = {
             "total_creators": len(creators),
             "new_videos": len(new_videos),
+            "new_video_ids": [v["db_id"] for v in new_videos],
             "elapsed_time": elapsed,
         }
 
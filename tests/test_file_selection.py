@@ -0,0 +1,60 @@
+import unittest
+import os
+import sys
+
+# 添加项目根目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bots.file_selection import match_file_selection
+
+
+FILES = [
+    {'name': 'video.mp4', 'type': '视频文件'},
+    {'name': 'video.srt', 'type': '字幕文件'},
+    {'name': 'video.md', 'type': '文档文件'},
+    {'name': 'video_2.srt', 'type': '字幕文件'},
+]
+
+
+class TestMatchFileSelection(unittest.TestCase):
+    """help-bot 文件选择的本地解析（不调用 Gemini）"""
+
+    def test_select_all(self):
+        """全部 / all 选择所有文件"""
+        self.assertEqual(match_file_selection('全部', FILES), [0, 1, 2, 3])
+        self.assertEqual(match_file_selection(' ALL ', FILES), [0, 1, 2, 3])
+
+    def test_number_list(self):
+        """1 起始的编号列表转换为 0 起始的索引"""
+        self.assertEqual(match_file_selection('1,3', FILES), [0, 2])
+        self.assertEqual(match_file_selection('1，2、4', FILES), [0, 1, 3])
+        self.assertEqual(match_file_selection('2 and 3', FILES), [1, 2])
+
+    def test_number_list_with_he(self):
+        """“1 和 3” 也在本地解析"""
+        self.assertEqual(match_file_selection('1 和 3', FILES), [0, 2])
+        self.assertEqual(match_file_selection('2和4', FILES), [1, 3])
+
+    def test_number_list_drops_out_of_range(self):
+        """超出范围的编号被忽略"""
+        self.assertEqual(match_file_selection('0, 2, 9', FILES), [1])
+
+    def test_only_type(self):
+        """只要字幕 / 只要文档文件 按类型选择"""
+        self.assertEqual(match_file_selection('只要字幕', FILES), [1, 3])
+        self.assertEqual(match_file_selection('只要文档文件', FILES), [2])
+
+    def test_exit(self):
+        """退出关键词返回 [-1]"""
+        self.assertEqual(match_file_selection('完成', FILES), [-1])
+        self.assertEqual(match_file_selection('Done', FILES), [-1])
+
+    def test_free_form_needs_gemini(self):
+        """自由表述返回 None，交给 Gemini 解析"""
+        self.assertIsNone(match_file_selection('第一个和最后一个', FILES))
+        self.assertIsNone(match_file_selection('只要音频', FILES))
+        self.assertIsNone(match_file_selection('和', FILES))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import os
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+
+# 添加项目根目录到路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from second_brain.database import Database, to_timestamp
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """使用临时目录中的数据库"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = Path(self.tmpdir.name) / "second_brain.db"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def count_creators(self) -> int:
+        """从另一个连接读取，只能看到已提交的数据"""
+        conn = sqlite3.connect(str(self.db_path))
+        try:
+            return conn.execute("SELECT COUNT(*) FROM creators").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class TestTransaction(DatabaseTestCase):
+    """Database.transaction() 的嵌套提交/回滚"""
+
+    def test_outer_transaction_commits(self):
+        """最外层事务退出时提交"""
+        with Database(str(self.db_path)) as db:
+            with db.transaction():
+                db.add_creator("bilibili", "1", "UP1")
+                db.add_creator("bilibili", "2", "UP2")
+            self.assertEqual(self.count_creators(), 2)
+
+    def test_nested_block_does_not_commit_early(self):
+        """内层 add_creator 退出时不提交，等最外层一起提交"""
+        with Database(str(self.db_path)) as db:
+            with db.transaction():
+                db.add_creator("bilibili", "1", "UP1")
+                self.assertTrue(db.conn.in_transaction)
+                self.assertEqual(self.count_creators(), 0)
+            self.assertFalse(db.conn.in_transaction)
+            self.assertEqual(self.count_creators(), 1)
+
+    def test_inner_exception_rolls_back_everything(self):
+        """内层异常传出最外层时，整个事务回滚"""
+        with Database(str(self.db_path)) as db:
+            with self.assertRaises(RuntimeError):
+                with db.transaction():
+                    db.add_creator("bilibili", "1", "UP1")
+                    with db.transaction() as cursor:
+                        cursor.execute(
+                            "INSERT INTO creators (platform, uid, name) VALUES (?, ?, ?)",
+                            ("bilibili", "2", "UP2"))
+                        raise RuntimeError("boom")
+            self.assertEqual(db._tx_depth, 0)
+            self.assertEqual(db.get_creators(), [])
+
+            # 回滚后数据库仍可正常写入
+            db.add_creator("bilibili", "3", "UP3")
+            self.assertEqual(self.count_creators(), 1)
+
+
+class TestPublishedTs(DatabaseTestCase):
+    """published_ts 迁移与按 ID 查询"""
+
+    def test_migrate_published_ts_backfills_old_rows(self):
+        """旧库缺少 published_ts 列时添加并回填"""
+        conn = sqlite3.connect(str(self.db_path))
+        conn.execute("""
+            CREATE TABLE videos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                creator_id INTEGER,
+                platform TEXT NOT NULL,
+                video_id TEXT NOT NULL,
+                title TEXT,
+                published_at TIMESTAMP,
+                UNIQUE(platform, video_id)
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO videos (platform, video_id, title, published_at) VALUES (?, ?, ?, ?)",
+            [("bilibili", "BV1", "iso", "2026-01-02T03:04:05"),
+             ("bilibili", "BV2", "rss", "Fri, 02 Jan 2026 03:04:05 GMT"),
+             ("bilibili", "BV3", "none", None)])
+        conn.commit()
+        conn.close()
+
+        with Database(str(self.db_path)) as db:
+            rows = {row['video_id']: row['published_ts']
+                    for row in db.conn.execute("SELECT video_id, published_ts FROM videos")}
+
+        self.assertEqual(rows["BV1"], to_timestamp("2026-01-02T03:04:05"))
+        self.assertEqual(rows["BV2"], to_timestamp("Fri, 02 Jan 2026 03:04:05 GMT"))
+        self.assertIsNone(rows["BV3"])
+
+    def test_get_videos_by_ids(self):
+        """按数据库 ID 查询，忽略不存在的 ID，空列表不查询"""
+        with Database(str(self.db_path)) as db:
+            creator_id = db.add_creator("bilibili", "1", "UP1")
+            first = db.add_video(creator_id, "bilibili", "BV1", "old", published_at="2026-01-01T00:00:00")
+            second = db.add_video(creator_id, "bilibili", "BV2", "new", published_at="2026-01-02T00:00:00")
+
+            videos = db.get_videos_by_ids([first, second, 999])
+            self.assertEqual([v['video_id'] for v in videos], ["BV2", "BV1"])
+            self.assertEqual(videos[0]['published_ts'], to_timestamp("2026-01-02T00:00:00"))
+            self.assertEqual(db.get_videos_by_ids([]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()